@@ -16,13 +16,14 @@ def main():
     parser.add_argument("-l", "--log-file", help="File to write logs to")
     parser.add_argument("--log-level", type=int, default=0, help="Logging level")
     parser.add_argument("--validate", action="store_true", help="Only perform validation")
+    parser.add_argument("--debug", action="store_true", help="Also write the intermediate aligner_tmp.yaml file")
 
     args = parser.parse_args()
     print("aligner: ", args)
 
     logger = utils.Logger(logfile=args.log_file, level=args.log_level)
 
-    a = Aligner(args.version_dir, args.metadata_file, args.xtalforms, logger=logger)
+    a = Aligner(args.version_dir, args.metadata_file, args.xtalforms, logger=logger, debug=args.debug)
     num_errors, num_warnings = a.validate()
 
     if not args.validate:
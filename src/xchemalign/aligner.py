@@ -11,9 +11,15 @@
 # limitations under the License.
 
 import argparse
+import functools
+import hashlib
+import json
 import os
+import sys
 import traceback
 import shutil
+import stat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import yaml
@@ -62,18 +68,65 @@ from xchemalign.utils import Constants
 from xchemalign.pdb_xtal import PDBXtal
 
 
+# the fs model loaders that give an empty dict when their file does not exist yet
+_EMPTY_WHEN_MISSING = frozenset(
+    {
+        "dataset_assignments",
+        "ligand_neighbourhoods",
+        "ligand_neighbourhood_transforms",
+        "conformer_sites",
+        "conformer_site_transforms",
+        "canonical_sites",
+        "canonical_site_transforms",
+        "xtalform_sites",
+        "reference_structure_transforms",
+    }
+)
+
+
 def try_make(path):
-    if not Path(path).exists():
-        os.mkdir(path)
+    Path(path).mkdir(parents=True, exist_ok=True)
 
 
 def read_yaml(path):
     with open(path, 'r') as f:
-        dic = yaml.safe_load(f)
+        dic = yaml.load(f, Loader=utils.SafeLoader)
 
     return dic
 
 
+@functools.lru_cache(maxsize=256)
+def _read_cell_sg(pdb_path):
+    """
+    Read the spacegroup and unit cell of a structure.
+    For PDB files these come from the CRYST1 record so the file is only read up to that line and the atoms are never
+    parsed. Anything without a CRYST1 record (e.g. mmCIF) falls back to a full gemmi read.
+
+    :param pdb_path: path to the structure file
+    :returns: tuple of the spacegroup (H-M symbol) and a tuple of the cell a, b, c, alpha, beta, gamma
+    """
+    # read as bytes so that whatever is in the other header records can't fail to decode
+    with open(pdb_path, "rb") as pdb:
+        for line in pdb:
+            if line.startswith(b"CRYST1"):
+                line = line.decode("ascii", errors="replace")
+                cell = (
+                    float(line[6:15]),
+                    float(line[15:24]),
+                    float(line[24:33]),
+                    float(line[33:40]),
+                    float(line[40:47]),
+                    float(line[47:54]),
+                )
+                return line[55:66].strip(), cell
+            if line.startswith((b"ATOM", b"HETATM")):
+                break
+
+    structure = gemmi.read_structure(str(pdb_path))
+    cell = structure.cell
+    return structure.spacegroup_hm, (cell.a, cell.b, cell.c, cell.alpha, cell.beta, cell.gamma)
+
+
 def path_to_relative_string(
     path,
     base_path,
@@ -94,14 +147,33 @@ def traverse_dictionary(dic, func):
             dic[key] = func(value)
 
 
-def _get_xmap_path_or_none(output_path, binding_event):
+def _get_xmap_path_or_none(output_prefix, binding_event):
     xmap_file = binding_event.get(Constants.META_FILE)
     if xmap_file:
-        return str(output_path / xmap_file)
+        return output_prefix + xmap_file
     else:
         return None
 
 
+def _get_ligand_binding_event(dtag, binding_event, output_prefix):
+    """
+    Generate the key and LigandBindingEvent for a binding event from the metadata.
+    The id strings are interned as the same dtag, chain and residue values recur across many keys.
+
+    :return: tuple of ((dtag, chain, residue), LigandBindingEvent)
+    """
+    chain = sys.intern(str(binding_event.get(Constants.META_PROT_CHAIN)))
+    residue = sys.intern(str(binding_event.get(Constants.META_PROT_RES)))
+    ligand_binding_event = dt.LigandBindingEvent(
+        id=0,
+        dtag=dtag,
+        chain=chain,
+        residue=residue,
+        xmap=_get_xmap_path_or_none(output_prefix, binding_event),
+    )
+    return (dtag, chain, residue), ligand_binding_event
+
+
 def get_datasets_from_crystals(crystals, output_path):
     # dataset_ids = [DatasetID(dtag=dtag) for dtag in crystals]
     # paths to files will be defined like this: upload_1/crystallographic_files/8dz1/8dz1.pdb
@@ -109,70 +181,126 @@ def get_datasets_from_crystals(crystals, output_path):
     datasets = {}
     reference_datasets = {}
     new_datasets = {}
+    # the files are all relative to output_path so join them as strings rather than creating a Path for each
+    output_prefix = os.fspath(output_path) + os.sep
+    xtal_files_key = Constants.META_XTAL_FILES
+    binding_event_key = Constants.META_BINDING_EVENT
+    file_key = Constants.META_FILE
+    pdb_key = Constants.META_XTAL_PDB
+    mtz_key = Constants.META_XTAL_MTZ
+    status_key = Constants.META_STATUS
+    status_new = Constants.META_STATUS_NEW
+    reference_key = Constants.META_REFERENCE
     for dtag, crystal in crystals.items():
+        xtal_files = crystal[xtal_files_key]
+        binding_events = xtal_files.get(binding_event_key, ())
+        dtag_str = sys.intern(str(dtag))
+        mtz_file = utils.find_nested(xtal_files, mtz_key, file_key)
         dataset = dt.Dataset(
             dtag=dtag,
-            pdb=str(output_path / crystal[Constants.META_XTAL_FILES][Constants.META_XTAL_PDB][Constants.META_FILE]),
+            pdb=output_prefix + xtal_files[pdb_key][file_key],
             xmap="",
-            mtz=str(
-                output_path
-                / crystal[Constants.META_XTAL_FILES].get(Constants.META_XTAL_MTZ, {}).get(Constants.META_FILE)
+            mtz=output_prefix + mtz_file if mtz_file else None,
+            ligand_binding_events=dict(
+                _get_ligand_binding_event(dtag_str, binding_event, output_prefix) for binding_event in binding_events
             ),
-            # ligand_binding_events=LigandBindingEvents(
-            #     ligand_ids=[
-            #         LigandID(
-            #             dtag=dtag,
-            #             chain=binding_event.get(Constants.META_PROT_CHAIN),
-            #             residue=binding_event.get(Constants.META_PROT_RES),
-            #         )
-            #         for binding_event in crystal[Constants.META_XTAL_FILES].get(Constants.META_BINDING_EVENT, {})
-            #     ],
-            #     ligand_binding_events=[
-            #         LigandBindingEvent(
-            #             id=0,
-            #             dtag=dtag,
-            #             chain=binding_event.get(Constants.META_PROT_CHAIN),
-            #             residue=binding_event.get(Constants.META_PROT_RES),
-            #             xmap=str(output_path / binding_event.get(Constants.META_FILE)),
-            #         )
-            #         for binding_event in crystal[Constants.META_XTAL_FILES].get(Constants.META_BINDING_EVENT, {})
-            #     ],
-            # ),
-            ligand_binding_events={
-                (
-                    str(dtag),
-                    str(binding_event.get(Constants.META_PROT_CHAIN)),
-                    str(binding_event.get(Constants.META_PROT_RES)),
-                ): dt.LigandBindingEvent(
-                    id=0,
-                    dtag=str(dtag),
-                    chain=str(binding_event.get(Constants.META_PROT_CHAIN)),
-                    residue=str(binding_event.get(Constants.META_PROT_RES)),
-                    xmap=_get_xmap_path_or_none(output_path, binding_event),
-                )
-                for binding_event in crystal[Constants.META_XTAL_FILES].get(Constants.META_BINDING_EVENT, {})
-            },
         )
         datasets[dtag] = dataset
-        if crystal[Constants.META_STATUS] == Constants.META_STATUS_NEW:
+        if crystal[status_key] == status_new:
             new_datasets[dtag] = dataset
-        if crystal.get(Constants.META_REFERENCE):
+        if crystal.get(reference_key):
             reference_datasets[dtag] = dataset
 
-    if (len(datasets) == 0) or (len(datasets) == 0):
-        # self.logger.error(f"Did not find any datasets in metadata_file. Exiting.")
-        raise Exception
-
-    # self.logger.info(f"Ligand binding events in datasets:")
-    for _dataset_id, _dataset in datasets.items():
-        _num_binding_events = len(_dataset.ligand_binding_events)
-        # self.logger.info(f"\t{_dataset_id.dtag} : Num Ligand binding events: {_num_binding_events}")
+    if not datasets:
+        raise Exception("no datasets found in metadata file")
 
     return datasets, reference_datasets, new_datasets
 
 
+# the version of the components extracted by PDBXtal - bump this whenever what it writes changes, so that the
+# components extracted by earlier versions are not reused
+_EXTRACT_VERSION = 1
+
+
+@functools.lru_cache(maxsize=None)
+def _get_extract_salt():
+    # the extraction version, plus the list of non-ligand residues that decides what goes in the apo files
+    with open(os.path.join(os.path.dirname(__file__), "non_ligs.json"), "rb") as f:
+        return "{}\0".format(_EXTRACT_VERSION).encode() + f.read()
+
+
+def _get_extract_digest(pdb, cif_digest, chain, ligand):
+    """
+    Generate a digest of everything that determines the components extracted from an aligned structure.
+
+    :return: The hex digest, or None if the structure file cannot be read
+    """
+    h = hashlib.blake2b(_get_extract_salt(), digest_size=16)
+    try:
+        with open(pdb, "rb") as f:
+            h.update(f.read())
+    except OSError:
+        return None
+    h.update("\0{}\0{}\0{}".format(cif_digest, chain, ligand).encode())
+    return h.hexdigest()
+
+
+def _extract_one(args):
+    """
+    Extract the components of a single aligned structure.
+    This is run in a worker process, so instead of logging it returns the messages for the caller to log.
+
+    :param args: tuple of (base_dir, pdb, cif_file, xtal, chain, ligand, conformer site)
+    :return: tuple of (metadata to add for the structure, number of errors, list of (level, message) tuples)
+    """
+    base_dir, pdb, cif_file, k1, k2, k3, k4 = args
+    base_dir = Path(base_dir)
+    data = {}
+    messages = [(0, ("extracting components", k1, k2, k3, k4, pdb))]
+    # pth = self.version_dir / pdb
+    pth = Path(pdb)
+    st = utils.stat_or_none(pth)
+    if st is None or not stat.S_ISREG(st.st_mode):
+        messages.append((2, ("can't find file", pth)))
+        return data, 1, messages
+
+    pdbxtal = PDBXtal(pth, pth.parent)
+    errs = pdbxtal.validate()
+    if errs:
+        messages.append((2, ("validation errors - can't extract components",)))
+        return data, 1, messages
+
+    pdbxtal.create_apo_file()
+    pdbxtal.create_apo_solv_desolv()
+
+    data[Constants.META_PDB_APO] = str(pdbxtal.apo_file.relative_to(base_dir))
+    data[Constants.META_PDB_APO_SOLV] = str(pdbxtal.apo_solv_file.relative_to(base_dir))
+    data[Constants.META_PDB_APO_DESOLV] = str(pdbxtal.apo_desolv_file.relative_to(base_dir))
+    if cif_file:
+        try:
+            pdbxtal.create_ligands(k2, k3, str(base_dir / cif_file))
+            data[Constants.META_LIGAND_MOL] = str(pdbxtal.ligand_base_file.relative_to(base_dir)) + '.mol'
+            data[Constants.META_LIGAND_PDB] = str(pdbxtal.ligand_base_file.relative_to(base_dir)) + '.pdb'
+            data[Constants.META_LIGAND_SMILES] = pdbxtal.smiles
+        except:
+            messages.append(
+                (
+                    1,
+                    (
+                        "failed to create ligand for",
+                        k1,
+                        "Check that the ligand in PDB file and the CIF file are compatible",
+                    ),
+                )
+            )
+            traceback.print_exc()
+            return data, 1, messages
+
+    return data, 0, messages
+
+
 class Aligner:
-    def __init__(self, version_dir, metadata, xtalforms, logger=None):
+    def __init__(self, version_dir, metadata, xtalforms, logger=None, debug=False):
         self.version_dir = Path(version_dir)  # e.g. path/to/upload_1
         self.base_dir = self.version_dir.parent  # e.g. path/to
         self.aligned_dir = self.version_dir / Constants.META_ALIGNED_FILES  # e.g. path/to/upload_1/aligned_files
@@ -186,6 +314,7 @@ class Aligner:
             self.logger = logger
         else:
             self.logger = utils.Logger()
+        self.debug = debug
         self.errors = []
         self.warnings = []
 
@@ -194,21 +323,24 @@ class Aligner:
         self.errors.append(msg)
 
     def validate(self):
-        if not self.version_dir.exists():
+        st = utils.stat_or_none(self.version_dir)
+        if st is None:
             self._log_error("version dir {} does not exist".format(self.version_dir))
-        elif not self.version_dir.is_dir():
+        elif not stat.S_ISDIR(st.st_mode):
             self._log_error("version dir {} is not a directory".format(self.version_dir))
         else:
             p = self.metadata_file
-            if not p.exists():
+            st = utils.stat_or_none(p)
+            if st is None:
                 self._log_error("metadata file {} does not exist".format(p))
-            if not p.is_file():
+            elif not stat.S_ISREG(st.st_mode):
                 self._log_error("metadata file {} is not a file".format(p))
 
-            p = Path(self.xtalforms_file)
-            if not p.exists():
+            p = self.xtalforms_file
+            st = utils.stat_or_none(p)
+            if st is None:
                 self._log_error("xtalforms file {} does not exist".format(p))
-            elif not p.is_file():
+            elif not stat.S_ISREG(st.st_mode):
                 self._log_error("xtalforms file {} is not a file".format(p))
 
         return len(self.errors), len(self.warnings)
@@ -251,12 +383,14 @@ class Aligner:
             lambda x: path_to_relative_string(x, self.base_dir),
         )
 
-        # remove this eventually
-        with open(self.version_dir / 'aligner_tmp.yaml', "w") as stream:
-            yaml.dump(aligner_dict, stream, sort_keys=False, default_flow_style=None)
+        if self.debug:
+            with open(self.version_dir / 'aligner_tmp.yaml', "w", buffering=utils.WRITE_BUFFER_SIZE) as stream:
+                yaml.dump(aligner_dict, stream, Dumper=utils.Dumper, sort_keys=False, default_flow_style=False)
 
-        with open(self.version_dir / Constants.METADATA_ALIGN_FILENAME, "w") as stream:
-            yaml.dump(collator_dict, stream, sort_keys=False, default_flow_style=None)
+        with open(
+            self.version_dir / Constants.METADATA_ALIGN_FILENAME, "w", buffering=utils.WRITE_BUFFER_SIZE
+        ) as stream:
+            utils.dump_yaml_sections(collator_dict, stream, stream_keys=(Constants.META_XTALS,))
 
     def _copy_file_to_version_dir(self, file_path):
         f = shutil.copy2(file_path, self.version_dir)
@@ -278,7 +412,7 @@ class Aligner:
             self.logger.error(f"Did not find any crystals in metadata file. Exiting.")
             raise Exception
         previous_version_dirs = meta.get(Constants.META_PREV_VERSION_DIRS)
-        if len(previous_version_dirs) > 0:
+        if previous_version_dirs:
             previous_output_path = self.base_dir / previous_version_dirs[-1]
         else:
             previous_output_path = None
@@ -286,8 +420,8 @@ class Aligner:
         output_path = self.version_dir
 
         aligned_files_dir = output_path / Constants.META_ALIGNED_FILES
-        if not aligned_files_dir.exists():
-            os.mkdir(aligned_files_dir)
+        # this also creates output_path if needed
+        aligned_files_dir.mkdir(parents=True, exist_ok=True)
 
         # Load the previous output dir if there is one
         if previous_output_path:
@@ -305,104 +439,49 @@ class Aligner:
             fs_model.reference_alignments = source_fs_model.reference_alignments
 
         # # symlink old aligned files
-        # if previous_output_path:
-        #     if Path(previous_output_path).resolve() != output_path.resolve():
-        #         fs_model.symlink_old_data()
-
-        # Create output dir
-        if not output_path.exists():
-            os.mkdir(output_path)
+        # if previous_output_path and Path(previous_output_path).resolve() != output_path.resolve():
+        #     fs_model.symlink_old_data()
 
         # Get the datasets
         datasets, reference_datasets, new_datasets = get_datasets_from_crystals(crystals, self.base_dir)
 
-        # Get assemblies
-        if source_fs_model:
-            assemblies: dict[str, dt.Assembly] = _load_assemblies(source_fs_model.xtalforms, self.xtalforms_file)
-        else:
-            assemblies = _load_assemblies(fs_model.xtalforms, self.xtalforms_file)
-
-        # # Get xtalforms
-        if source_fs_model:
-            xtalforms: dict[str, dt.XtalForm] = _load_xtalforms(source_fs_model.xtalforms, self.xtalforms_file)
-        else:
-            xtalforms = _load_xtalforms(fs_model.xtalforms, self.xtalforms_file)
-
-        # Get the dataset assignments
-        if source_fs_model:
-            dataset_assignments = _load_dataset_assignments(Path(source_fs_model.dataset_assignments))
-        else:
-            dataset_assignments = _load_dataset_assignments(Path(fs_model.dataset_assignments))
-
-        # Get Ligand neighbourhoods
-        if source_fs_model:
-            ligand_neighbourhoods: dict[tuple[str, str, str], dt.Neighbourhood] = _load_ligand_neighbourhoods(
-                source_fs_model.ligand_neighbourhoods
-            )
-        else:
-            ligand_neighbourhoods = _load_ligand_neighbourhoods(fs_model.ligand_neighbourhoods)
-
-        # Get alignability graph
-        if source_fs_model:
-            alignability_graph = _load_alignability_graph(source_fs_model.alignability_graph)
-        else:
-            alignability_graph = _load_alignability_graph(fs_model.alignability_graph)
-
-        #
-        if source_fs_model:
-            print(f"Have source fs model at {source_fs_model.ligand_neighbourhood_transforms}!")
-            ligand_neighbourhood_transforms: dict[
-                tuple[tuple[str, str, str], tuple[str, str, str]], dt.Transform
-            ] = _load_ligand_neighbourhood_transforms(source_fs_model.ligand_neighbourhood_transforms)
-        else:
-            ligand_neighbourhood_transforms = _load_ligand_neighbourhood_transforms(
-                fs_model.ligand_neighbourhood_transforms
-            )
-        print(ligand_neighbourhood_transforms)
-
-        # Get conformer sites
-        if source_fs_model:
-            conformer_sites: dict[str, dt.ConformerSite] = _load_conformer_sites(source_fs_model.conformer_sites)
-        else:
-            conformer_sites = _load_conformer_sites(fs_model.conformer_sites)
-
-        #
-        if source_fs_model:
-            conformer_site_transforms: dict[tuple[str, str], dt.Transform] = _load_conformer_site_transforms(
-                source_fs_model.conformer_site_transforms
-            )
-        else:
-            conformer_site_transforms = _load_conformer_site_transforms(fs_model.conformer_site_transforms)
-
-        # Get canonical sites
-        if source_fs_model:
-            canonical_sites: dict[str, dt.CanonicalSite] = _load_canonical_sites(source_fs_model.canonical_sites)
-        else:
-            canonical_sites = _load_canonical_sites(fs_model.canonical_sites)
-
-        #
-        if source_fs_model:
-            canonical_site_transforms: dict[str, dt.Transform] = _load_canonical_site_transforms(
-                source_fs_model.conformer_site_transforms
-            )
-        else:
-            canonical_site_transforms = _load_canonical_site_transforms(fs_model.conformer_site_transforms)
-
-        # Get xtalform sites
-        if source_fs_model:
-            xtalform_sites: dict[str, dt.XtalFormSite] = _load_xtalform_sites(source_fs_model.xtalform_sites)
-        else:
-            xtalform_sites = _load_xtalform_sites(fs_model.xtalform_sites)
-
-        # Get reference structure transforms
-        if source_fs_model:
-            reference_structure_transforms: dict[tuple[str, str], dt.Transform] = _load_reference_stucture_transforms(
-                source_fs_model.reference_structure_transforms
-            )
-        else:
-            reference_structure_transforms = _load_reference_stucture_transforms(
-                fs_model.reference_structure_transforms
-            )
+        # Load the state of the previous version, or the (empty) state of this version if it is the first run.
+        # The loaders are independent and mostly waiting on file reads so run them concurrently.
+        model = source_fs_model if source_fs_model else fs_model
+        loaders = [
+            ("assemblies", _load_assemblies, (model.xtalforms, self.xtalforms_file)),
+            ("xtalforms", _load_xtalforms, (model.xtalforms, self.xtalforms_file)),
+            ("dataset_assignments", _load_dataset_assignments, (Path(model.dataset_assignments),)),
+            ("ligand_neighbourhoods", _load_ligand_neighbourhoods, (model.ligand_neighbourhoods,)),
+            ("alignability_graph", _load_alignability_graph, (model.alignability_graph,)),
+            (
+                "ligand_neighbourhood_transforms",
+                _load_ligand_neighbourhood_transforms,
+                (model.ligand_neighbourhood_transforms,),
+            ),
+            ("conformer_sites", _load_conformer_sites, (model.conformer_sites,)),
+            ("conformer_site_transforms", _load_conformer_site_transforms, (model.conformer_site_transforms,)),
+            ("canonical_sites", _load_canonical_sites, (model.canonical_sites,)),
+            ("canonical_site_transforms", _load_canonical_site_transforms, (model.conformer_site_transforms,)),
+            ("xtalform_sites", _load_xtalform_sites, (model.xtalform_sites,)),
+            (
+                "reference_structure_transforms",
+                _load_reference_stucture_transforms,
+                (model.reference_structure_transforms,),
+            ),
+        ]
+        loaded = {}
+        futures = {}
+        # libyaml releases the GIL while parsing so the threads overlap parsing as well as the reads
+        with ThreadPoolExecutor(max_workers=min(len(loaders), (os.cpu_count() or 4) * 2)) as executor:
+            for name, loader, args in loaders:
+                if source_fs_model is None and name in _EMPTY_WHEN_MISSING and not Path(args[0]).exists():
+                    # first run so there is nothing to load
+                    loaded[name] = {}
+                else:
+                    futures[executor.submit(loader, *args)] = name
+            for future in as_completed(futures):
+                loaded[futures[future]] = future.result()
 
         # Run the update
         updated_fs_model = _update(
@@ -410,17 +489,17 @@ class Aligner:
             datasets,
             reference_datasets,
             new_datasets,
-            assemblies,
-            xtalforms,
-            dataset_assignments,
-            ligand_neighbourhoods,
-            alignability_graph,
-            ligand_neighbourhood_transforms,
-            conformer_sites,
-            conformer_site_transforms,
-            canonical_sites,
-            xtalform_sites,
-            reference_structure_transforms,
+            loaded["assemblies"],
+            loaded["xtalforms"],
+            loaded["dataset_assignments"],
+            loaded["ligand_neighbourhoods"],
+            loaded["alignability_graph"],
+            loaded["ligand_neighbourhood_transforms"],
+            loaded["conformer_sites"],
+            loaded["conformer_site_transforms"],
+            loaded["canonical_sites"],
+            loaded["xtalform_sites"],
+            loaded["reference_structure_transforms"],
         )
 
         # Update the metadata_file with aligned file locations and site information
@@ -431,20 +510,18 @@ class Aligner:
         xtalforms = read_yaml(updated_fs_model.xtalforms)
         for xtalform_id, xtalform in xtalforms['xtalforms'].items():
             xtalform_reference = xtalform["reference"]
-            reference_structure = gemmi.read_structure(datasets[xtalform_reference].pdb)  # (xtalform_reference).pdb)
-            reference_spacegroup = reference_structure.spacegroup_hm
-            reference_unit_cell = reference_structure.cell
+            reference_spacegroup, (a, b, c, alpha, beta, gamma) = _read_cell_sg(datasets[xtalform_reference].pdb)
 
             meta_xtalforms[xtalform_id] = {
                 Constants.META_XTALFORM_REFERENCE: xtalform_reference,
                 Constants.META_XTALFORM_SPACEGROUP: reference_spacegroup,
                 Constants.META_XTALFORM_CELL: {
-                    "a": reference_unit_cell.a,
-                    "b": reference_unit_cell.b,
-                    "c": reference_unit_cell.c,
-                    "alpha": reference_unit_cell.alpha,
-                    "beta": reference_unit_cell.beta,
-                    "gamma": reference_unit_cell.gamma,
+                    "a": a,
+                    "b": b,
+                    "c": c,
+                    "alpha": alpha,
+                    "beta": beta,
+                    "gamma": gamma,
                 },
             }
 
@@ -540,41 +617,42 @@ class Aligner:
         #                     Constants.META_AIGNED_X_MAP: aligned_xmap_path,
         #                 }
 
-        new_meta[Constants.META_XTALS] = {}
-        for dtag, crystal in crystals.items():
+        structure_key = Constants.META_AIGNED_STRUCTURE
+        artefacts_key = Constants.META_AIGNED_ARTEFACTS
+        event_map_key = Constants.META_AIGNED_EVENT_MAP
+        xmap_key = Constants.META_AIGNED_X_MAP
+        diff_map_key = Constants.META_AIGNED_DIFF_MAP
+        alignments = fs_model.alignments
+        xtals_meta = new_meta[Constants.META_XTALS] = {}
+        for dtag in crystals:
             self.logger.info('looking at', dtag)
+            dataset_output = alignments.get(dtag)
             # Skip if no output for this dataset
-            if dtag not in fs_model.alignments:
+            if dataset_output is None:
                 self.logger.warn('skipping {} as aligned structures not found'.format(dtag))
                 continue
 
-            new_meta[Constants.META_XTALS][dtag] = {}
-            crystal_output = new_meta[Constants.META_XTALS][dtag] = {}
-            # aligned_files = crystal_output[Constants.META_ALIGNED_FILES]
-
-            # Otherwise iterate the output data structure, adding the aligned structure,
+            # Otherwise build the output data structure, adding the aligned structure,
             # artefacts, xmaps and event maps to the metadata_file
-            assigned_xtalform = assigned_xtalforms[dtag]
-            crystal_output[Constants.META_ASSIGNED_XTALFORM] = assigned_xtalform
-
-            aligned_output = crystal_output[Constants.META_ALIGNED_FILES] = {}
-            dataset_output = fs_model.alignments[dtag]
-            for chain_name, chain_output in dataset_output.items():
-                aligned_chain_output = aligned_output[chain_name] = {}
-                for ligand_residue, ligand_output in chain_output.items():
-                    aligned_ligand_output = aligned_chain_output[ligand_residue] = {}
-                    for site_id, aligned_structure_path in ligand_output.aligned_structures.items():
-                        aligned_artefacts_path = ligand_output.aligned_artefacts[site_id]
-                        aligned_event_map_path = ligand_output.aligned_event_maps[site_id]
-                        aligned_xmap_path = ligand_output.aligned_xmaps[site_id]
-                        aligned_diff_map_path = ligand_output.aligned_diff_maps[site_id]
-                        aligned_ligand_output[site_id] = {
-                            Constants.META_AIGNED_STRUCTURE: aligned_structure_path,
-                            Constants.META_AIGNED_ARTEFACTS: aligned_artefacts_path,
-                            Constants.META_AIGNED_EVENT_MAP: aligned_event_map_path,
-                            Constants.META_AIGNED_X_MAP: aligned_xmap_path,
-                            Constants.META_AIGNED_DIFF_MAP: aligned_diff_map_path,
+            xtals_meta[dtag] = {
+                Constants.META_ASSIGNED_XTALFORM: assigned_xtalforms[dtag],
+                Constants.META_ALIGNED_FILES: {
+                    chain_name: {
+                        ligand_residue: {
+                            site_id: {
+                                structure_key: aligned_structure_path,
+                                artefacts_key: ligand_output.aligned_artefacts[site_id],
+                                event_map_key: ligand_output.aligned_event_maps[site_id],
+                                xmap_key: ligand_output.aligned_xmaps[site_id],
+                                diff_map_key: ligand_output.aligned_diff_maps[site_id],
+                            }
+                            for site_id, aligned_structure_path in ligand_output.aligned_structures.items()
                         }
+                        for ligand_residue, ligand_output in chain_output.items()
+                    }
+                    for chain_name, chain_output in dataset_output.items()
+                },
+            }
 
         ## Add the reference alignments
         new_meta[Constants.META_REFERENCE_ALIGNMENTS] = {}
@@ -677,71 +755,102 @@ class Aligner:
         4. *_ligand.mol - molfile of the ligand
         5. *_ligand.pdb - PDB of the ligand
 
-        :param meta:
-        :return:
+        Structures whose file, CIF and ligand are unchanged since an earlier run are not extracted again.
+        The earlier results are found from the digests recorded in the .extract_digests.json file in the base dir.
+        This is kept out of the version dir as that is what gets uploaded to Fragalysis.
+
+        :param crystals:
+        :param aligner_meta:
+        :return: The number of errors
         """
 
         self.logger.info('extracting components')
+        digests_file = self.base_dir / Constants.EXTRACT_DIGESTS_FILENAME
+        if digests_file.is_file():
+            old_digests = utils.read_json(digests_file)
+        else:
+            old_digests = {}
 
-        num_errors = 0
+        aligned_files_key = Constants.META_ALIGNED_FILES
+        xtal_files_key = Constants.META_XTAL_FILES
+        cif_key = Constants.META_XTAL_CIF
+        file_key = Constants.META_FILE
+        structure_key = Constants.META_AIGNED_STRUCTURE
+
+        # flatten the xtal -> chain -> ligand -> conformer site hierarchy into one list of structures to process
+        tasks = []
         for k1, v1 in aligner_meta.get(Constants.META_XTALS, {}).items():  # k = xtal
-            if Constants.META_ALIGNED_FILES in v1:
-                self.logger.info('handling', k1)
-                cif_file = (
-                    crystals.get(k1)
-                    .get(Constants.META_XTAL_FILES, {})
-                    .get(Constants.META_XTAL_CIF, {})
-                    .get(Constants.META_FILE)
-                )
+            if aligned_files_key not in v1:
+                continue
+            # the CIF only depends on the crystal so look it up once rather than for every structure
+            cif_data = utils.find_nested(crystals[k1], xtal_files_key, cif_key)
+            if cif_data:
+                cif_file = cif_data.get(file_key)
+                cif_digest = cif_data.get(Constants.META_SHA256)
+            else:
+                cif_file = cif_digest = None
+            tasks.extend(
+                (k1, k2, k3, k4, v4, cif_file, cif_digest)
+                for k2, v2 in v1[aligned_files_key].items()  # chain
+                for k3, v3 in v2.items()  # ligand
+                for k4, v4 in v3.items()  # conf site
+            )
 
-                for k2, v2 in v1[Constants.META_ALIGNED_FILES].items():  # chain
-                    for k3, v3 in v2.items():  # ligand
-                        for k4, v4 in v3.items():  # conf site
-                            pdb = v4[Constants.META_AIGNED_STRUCTURE]
-                            self.logger.info("extracting components", k1, k2, k3, k4, pdb)
-                            # pth = self.version_dir / pdb
-                            pth = Path(pdb)
-                            if not pth.is_file():
-                                self.logger.error("can't find file", pth)
-                                num_errors += 1
-                            else:
-                                pdbxtal = PDBXtal(pth, pth.parent)
-                                errs = pdbxtal.validate()
-                                if errs:
-                                    self.logger.error("validation errors - can't extract components")
-                                    num_errors += 1
-                                else:
-                                    pdbxtal.create_apo_file()
-                                    pdbxtal.create_apo_solv_desolv()
-
-                                    v4[Constants.META_PDB_APO] = str(pdbxtal.apo_file.relative_to(self.base_dir))
-                                    v4[Constants.META_PDB_APO_SOLV] = str(
-                                        pdbxtal.apo_solv_file.relative_to(self.base_dir)
-                                    )
-                                    v4[Constants.META_PDB_APO_DESOLV] = str(
-                                        pdbxtal.apo_desolv_file.relative_to(self.base_dir)
-                                    )
-                                    if cif_file:
-                                        try:
-                                            pdbxtal.create_ligands(k2, k3, str(self.base_dir / cif_file))
-                                            v4[Constants.META_LIGAND_MOL] = (
-                                                str(pdbxtal.ligand_base_file.relative_to(self.base_dir)) + '.mol'
-                                            )
-                                            v4[Constants.META_LIGAND_PDB] = (
-                                                str(pdbxtal.ligand_base_file.relative_to(self.base_dir)) + '.pdb'
-                                            )
-                                            v4[Constants.META_LIGAND_SMILES] = pdbxtal.smiles
-                                        except:
-                                            num_errors += 1
-                                            self.logger.warn(
-                                                "failed to create ligand for",
-                                                k1,
-                                                "Check that the ligand in PDB file and the CIF file are compatible",
-                                            )
-                                            traceback.print_exc()
+        # reuse the results for structures that have not changed
+        new_digests = {}
+        to_extract = []
+        for k1, k2, k3, k4, v4, cif_file, cif_digest in tasks:
+            pdb = v4[structure_key]
+            # keyed like the paths in the metadata so that the aligner can be run from any directory
+            key = str(Path(pdb).relative_to(self.base_dir))
+            digest = _get_extract_digest(pdb, cif_digest, k2, k3)
+            old = old_digests.get(key)
+            if digest and old and old["digest"] == digest and self._extracted_files_exist(old["data"]):
+                self.logger.info("components unchanged for", k1, k2, k3, k4, pdb)
+                v4.update(old["data"])
+                new_digests[key] = old
+            else:
+                to_extract.append((k1, k2, k3, k4, v4, cif_file, (key, digest)))
+
+        # each structure is independent and the work is CPU bound so spread it over processes
+        base_dir = str(self.base_dir)
+        args = [
+            (base_dir, v4[structure_key], cif_file, k1, k2, k3, k4) for k1, k2, k3, k4, v4, cif_file, _ in to_extract
+        ]
+        num_errors = 0
+        # usually everything is reused, and then no worker processes are started at all
+        if args:
+            num_workers = min(len(args), utils.available_cpu_count())
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                results = executor.map(_extract_one, args, chunksize=max(1, min(4, len(args) // num_workers)))
+                for task, (data, errors, messages) in zip(to_extract, results):
+                    for level, msg in messages:
+                        self.logger.log(*msg, level=level)
+                    task[4].update(data)
+                    num_errors += errors
+                    key, digest = task[6]
+                    if not errors and digest:
+                        new_digests[key] = {"digest": digest, "data": data}
+
+        # keep the entries for the other version dirs
+        old_digests.update(new_digests)
+        with open(digests_file, "w") as stream:
+            json.dump(old_digests, stream)
 
         return num_errors
 
+    def _extracted_files_exist(self, data):
+        for key in (
+            Constants.META_PDB_APO,
+            Constants.META_PDB_APO_SOLV,
+            Constants.META_PDB_APO_DESOLV,
+            Constants.META_LIGAND_MOL,
+            Constants.META_LIGAND_PDB,
+        ):
+            if key in data and not (self.base_dir / data[key]).is_file():
+                return False
+        return True
+
 
 def main():
     parser = argparse.ArgumentParser(description="aligner")
@@ -753,13 +862,14 @@ def main():
     parser.add_argument("-l", "--log-file", help="File to write logs to")
     parser.add_argument("--log-level", type=int, default=0, help="Logging level")
     parser.add_argument("--validate", action="store_true", help="Only perform validation")
+    parser.add_argument("--debug", action="store_true", help="Also write the intermediate aligner_tmp.yaml file")
 
     args = parser.parse_args()
     print("aligner: ", args)
 
     logger = utils.Logger(logfile=args.log_file, level=args.log_level)
 
-    a = Aligner(args.version_dir, args.metadata_file, args.xtalforms, logger=logger)
+    a = Aligner(args.version_dir, args.metadata_file, args.xtalforms, logger=logger, debug=args.debug)
     num_errors, num_warnings = a.validate()
 
     if not args.validate:
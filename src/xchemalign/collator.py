@@ -12,11 +12,12 @@
 
 import argparse
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import shutil
+import stat
 import datetime
 import re
-import yaml
 
 
 import gemmi
@@ -30,6 +31,10 @@ from xchemalign import dbreader
 from xchemalign import utils
 from xchemalign.utils import Constants
 
+_TARGET_NAME_RE = re.compile(r"^[A-Za-z][A-Za-z0-9_-]*$")
+# parsed once here rather than for every crystal
+_MODEL_BUILDING_DIR = Path(Constants.DEFAULT_MODEL_BUILDING_DIR)
+
 
 def generate_xtal_dir(input_path: Path, xtal_name: str):
     """
@@ -38,7 +43,7 @@ def generate_xtal_dir(input_path: Path, xtal_name: str):
     :param xtal_name:
     :return: The Path to the base dir for this crystal
     """
-    xtal_dir = input_path / Constants.DEFAULT_MODEL_BUILDING_DIR / xtal_name
+    xtal_dir = input_path / _MODEL_BUILDING_DIR / xtal_name
     return xtal_dir
 
 
@@ -49,6 +54,34 @@ def expand_file_path(filepath: Path, default="."):
         return Path(default) / filepath
 
 
+def stat_file(path, dir_listings):
+    """
+    Stat a path using a listing of its directory, so that files in the same directory (the PDB, MTZ and CIF of a
+    crystal usually are) need one directory read to find out which exist, and only those that do are stat'ed.
+
+    :param path: The path to check
+    :param dir_listings: Dict of the directory listings read so far, which is added to
+    :return: The os.stat_result of the path (following symlinks), or None if it does not exist
+    """
+    parent, name = os.path.split(path)
+    entries = dir_listings.get(parent)
+    if entries is None:
+        try:
+            with os.scandir(parent) as it:
+                entries = {e.name: e for e in it}
+        except (FileNotFoundError, NotADirectoryError):
+            entries = {}
+        dir_listings[parent] = entries
+    entry = entries.get(name)
+    if entry is None:
+        return None
+    try:
+        return entry.stat()
+    except FileNotFoundError:
+        # a symlink whose target does not exist
+        return None
+
+
 class Input:
     def __init__(
         self,
@@ -138,6 +171,14 @@ class Collator:
 
         self.panddas_missing_ok = utils.find_property(config, Constants.META_PANDDAS_MISSING_OK, default=[])
 
+        # the number of crystals whose files are copied at once, which sets how many I/O requests are in flight
+        self.copy_workers = utils.find_property(
+            config, Constants.CONFIG_COPY_WORKERS, default=min(16, (os.cpu_count() or 4) * 2)
+        )
+        # digests of the input files from earlier runs, so that unchanged files are not hashed again
+        # this is kept in the output dir so is only read once that has been validated
+        self.digest_cache = None
+
         self.version_number = None
         self.version_dir = None
         self.previous_version_dirs = []
@@ -218,6 +259,9 @@ class Collator:
         num_errors, num_warnings = self.validate_paths()
 
         if num_errors == 0:
+            self.digest_cache = utils.DigestCache(
+                self.output_path / Constants.DIGEST_CACHE_FILENAME, logger=self.logger
+            )
             self.logger.info("validating data")
             meta = self.validate_data()
         else:
@@ -235,7 +279,7 @@ class Collator:
             if len(self.target_name) < 4:
                 self._log_error("target_name must have at least 4 characters: " + self.target_name)
             else:
-                x = re.search("^[A-Za-z]+[A-Za-z0-9_\\-]*$", self.target_name)
+                x = _TARGET_NAME_RE.match(self.target_name)
                 if not x:
                     self._log_error("Invalid target_name: " + self.target_name)
 
@@ -303,23 +347,38 @@ class Collator:
         num_pdb_files = 0
         num_mtz_files = 0
         num_cif_files = 0
-
-        for index, row in df.iterrows():
+        to_hash = []
+        dir_listings = {}
+        # the stats of the files that were found, which are reused when hashing them
+        file_stats = {}
+        # the full paths are only needed to check the files exist so build them as strings from a fixed prefix
+        base_prefix = os.path.join(os.fspath(self.base_path), "")
+        model_building_dir = input.input_dir_path / _MODEL_BUILDING_DIR
+
+        columns = [
+            Constants.SOAKDB_XTAL_NAME,
+            Constants.SOAKDB_COL_REFINEMENT_OUTCOME,
+            Constants.SOAKDB_COL_PDB,
+            Constants.SOAKDB_COL_MTZ,
+            Constants.SOAKDB_COL_CIF,
+            Constants.SOAKDB_COL_LAST_UPDATED,
+        ]
+        # plain tuples are much cheaper than the Series that iterrows() creates for every row
+        for xtal_name, refinement_outcome, pdb_file, mtz_file, cif_file, last_updated_date in df[columns].itertuples(
+            index=False, name=None
+        ):
             count += 1
-            xtal_name = row[Constants.SOAKDB_XTAL_NAME]
 
             # Exclude datasets
             if xtal_name in input.exclude:
                 self._log_warning(f"Excluding dataset: {xtal_name}")
                 continue
 
-            status_str = str(row[Constants.SOAKDB_COL_REFINEMENT_OUTCOME])
+            status_str = str(refinement_outcome)
             if status_str.startswith("7"):
                 # need to check that this crystal was not encountered earlier, if so deprecate it
                 self.rejected_xtals.add(xtal_name)
             else:
-                xtal_dir = generate_xtal_dir(input.input_dir_path, xtal_name)
-                # print('xtal_dir:', xtal_dir)
                 if not xtal_name:
                     self._log_error("Crystal name not defined, cannot process row {}".format(xtal_name))
                 else:
@@ -327,7 +386,7 @@ class Collator:
                     missing_files = 0
                     expanded_files = []
                     colname = Constants.SOAKDB_COL_PDB
-                    file = row[colname]
+                    file = pdb_file
                     # RefinementPDB_latest file names are specified as absolute file names, but need to be handled as
                     # relative to the base_path
                     if not file:
@@ -336,9 +395,9 @@ class Collator:
                     else:
                         # print('handling', colname, file)
                         inputpath = utils.make_path_relative(Path(file))
-                        full_inputpath = self.base_path / inputpath
+                        full_inputpath = base_prefix + os.fspath(inputpath)
                         # print('generated', full_inputpath)
-                        ok = full_inputpath.exists()
+                        ok = file_stats[full_inputpath] = stat_file(full_inputpath, dir_listings)
                         if ok:
                             num_pdb_files += 1
                             expanded_files.append(inputpath)
@@ -352,14 +411,14 @@ class Collator:
 
                         # if we have a PDB file then continue to look for the others
                         colname = Constants.SOAKDB_COL_MTZ
-                        file = row[colname]
+                        file = mtz_file
                         # RefinementMTZ_latest file names are specified as absolute file names, but need to be
                         # handled as relative to the base_path
                         if file:
                             inputpath = utils.make_path_relative(Path(file))
-                            full_inputpath = self.base_path / inputpath
+                            full_inputpath = base_prefix + os.fspath(inputpath)
                             # print('generated', full_inputpath)
-                            ok = full_inputpath.exists()
+                            ok = file_stats[full_inputpath] = stat_file(full_inputpath, dir_listings)
                             if ok:
                                 num_mtz_files += 1
                                 expanded_files.append(inputpath)
@@ -372,17 +431,17 @@ class Collator:
                             self._log_warning("MTZ entry {} for {} not defined in SoakDB".format(colname, xtal_name))
 
                         colname = Constants.SOAKDB_COL_CIF
-                        file = row[colname]
+                        file = cif_file
                         # RefinementCIF file names are relative to the xtal_dir
                         if file:
                             p = Path(file)
                             if p.is_absolute():
                                 inputpath = p.relative_to("/")
                             else:
-                                inputpath = xtal_dir / file
-                            full_inputpath = self.base_path / inputpath
+                                inputpath = model_building_dir / xtal_name / file
+                            full_inputpath = base_prefix + os.fspath(inputpath)
                             # print('generated', full_inputpath)
-                            ok = full_inputpath.exists()
+                            ok = file_stats[full_inputpath] = stat_file(full_inputpath, dir_listings)
                             if ok:
                                 num_cif_files += 1
                                 expanded_files.append(inputpath)
@@ -406,32 +465,26 @@ class Collator:
                         data[Constants.CONFIG_TYPE] = Constants.CONFIG_TYPE_MODEL_BUILDING
                         self.logger.info("adding crystal (model_building)", xtal_name)
                         crystals[xtal_name] = data
-                        last_updated_date = row[Constants.SOAKDB_COL_LAST_UPDATED]
                         if last_updated_date:
                             dt_str = last_updated_date.strftime(utils._DATETIME_FORMAT)
                             data[Constants.META_LAST_UPDATED] = dt_str
-                        data[Constants.META_REFINEMENT_OUTCOME] = row[Constants.SOAKDB_COL_REFINEMENT_OUTCOME]
-                        digest = utils.gen_sha256(self.base_path / expanded_files[0])
-                        f_data = {
-                            Constants.META_XTAL_PDB: {
-                                Constants.META_FILE: str(expanded_files[0]),
-                                Constants.META_SHA256: digest,
-                            }
-                        }
-                        if expanded_files[1]:
-                            digest = utils.gen_sha256(self.base_path / expanded_files[1])
-                            f_data[Constants.META_XTAL_MTZ] = {
-                                Constants.META_FILE: str(expanded_files[1]),
-                                Constants.META_SHA256: digest,
-                            }
-                        if expanded_files[2]:
-                            digest = utils.gen_sha256(self.base_path / expanded_files[2])
-                            f_data[Constants.META_XTAL_CIF] = {
-                                Constants.META_FILE: str(expanded_files[2]),
-                                Constants.META_SHA256: digest,
-                            }
+                        data[Constants.META_REFINEMENT_OUTCOME] = refinement_outcome
+                        # the digests are filled in once all the rows are handled
+                        f_data = {}
+                        for key, path in zip(
+                            (Constants.META_XTAL_PDB, Constants.META_XTAL_MTZ, Constants.META_XTAL_CIF), expanded_files
+                        ):
+                            if path:
+                                f_data[key] = {Constants.META_FILE: str(path), Constants.META_SHA256: None}
+                                to_hash.append((f_data[key], base_prefix + os.fspath(path)))
                         data[Constants.META_XTAL_FILES] = f_data
 
+        # hash the files of all the crystals together so that they are hashed in parallel
+        files = [file for _, file in to_hash]
+        digests = self.digest_cache.sha256_many(files, stats=[file_stats[file] for file in files])
+        for (file_data, _), digest in zip(to_hash, digests):
+            file_data[Constants.META_SHA256] = digest
+
         self.logger.info("validator handled {} rows from database, {} were valid".format(count, processed))
         if num_mtz_files < num_pdb_files:
             self.logger.warn(
@@ -446,6 +499,7 @@ class Collator:
         num_pdb_files = 0
         num_mtz_files = 0
         ref_datasets = set(self.config.get(Constants.CONFIG_REF_DATASETS, []))
+        to_hash = []
         for child in (self.base_path / input.input_dir_path).iterdir():
             pdb = None
             mtz = None
@@ -458,19 +512,19 @@ class Collator:
                 if pdb:
                     self.logger.info("adding crystal (manual)", child.name)
                     num_pdb_files += 1
-                    digest = utils.gen_sha256(pdb)
                     data = {
                         Constants.META_XTAL_PDB: {
                             Constants.META_FILE: pdb.relative_to(self.base_path),
-                            Constants.META_SHA256: digest,
+                            Constants.META_SHA256: None,
                         }
                     }
+                    to_hash.append((data[Constants.META_XTAL_PDB], pdb))
                     if mtz:
-                        digest = utils.gen_sha256(mtz)
                         data[Constants.META_XTAL_MTZ] = {
                             Constants.META_FILE: mtz.relative_to(self.base_path),
-                            Constants.META_SHA256: digest,
+                            Constants.META_SHA256: None,
                         }
+                        to_hash.append((data[Constants.META_XTAL_MTZ], mtz))
                         num_mtz_files += 1
                     crystals[child.name] = {}
                     if child.name in ref_datasets:
@@ -478,21 +532,31 @@ class Collator:
                     crystals[child.name][Constants.CONFIG_TYPE] = Constants.CONFIG_TYPE_MANUAL
                     crystals[child.name][Constants.META_XTAL_FILES] = data
 
+        # hash the files of all the crystals together so that they are hashed in parallel
+        digests = self.digest_cache.sha256_many([file for _, file in to_hash])
+        for (file_data, _), digest in zip(to_hash, digests):
+            file_data[Constants.META_SHA256] = digest
+
         if num_mtz_files < num_pdb_files:
             self.logger.warn(
                 "{} PDB files were found, but only {} had corresponding MTZ files".format(num_pdb_files, num_mtz_files)
             )
 
     def read_versions(self):
-        # find out which version dirs exist
+        # find out which version dirs exist, reading the output dir once rather than testing for each one in turn
+        prefix = Constants.VERSION_DIR_PREFIX
+        dir_names = set()
+        # os.scandir(None) would list the current dir
+        if self.output_path:
+            try:
+                with os.scandir(self.output_path) as entries:
+                    dir_names = {e.name for e in entries if e.name.startswith(prefix) and e.is_dir()}
+            except FileNotFoundError:
+                pass
+        # the versions must be consecutive so stop at the first gap
         version = 1
-        while True:
-            v_dir = Constants.VERSION_DIR_PREFIX + str(version)
-            v_path = self.output_path / v_dir
-            if v_path.is_dir():
-                version += 1
-            else:
-                break
+        while prefix + str(version) in dir_names:
+            version += 1
         if version == 1:
             self.logger.error("No version directory found. Please create one named upload_1")
             return None
@@ -505,12 +569,18 @@ class Collator:
 
         # read the metadata from the earlier versions and record the version dirs
         if version > 1:
-            for v in range(1, version):
-                self.logger.info("reading metadata for version {}".format(v))
-                dir_name = Constants.VERSION_DIR_PREFIX + str(v)
-                meta = self.read_metadata(self.output_path / dir_name)
-                self.meta_history.append(meta)
-                self.previous_version_dirs.append(dir_name)
+            # the files are independent so read them concurrently, overlapping the filesystem latency with parsing
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                futures = []
+                for v in range(1, version):
+                    self.logger.info("reading metadata for version", v)
+                    dir_name = Constants.VERSION_DIR_PREFIX + str(v)
+                    # logged here rather than in the worker threads so that it comes out in version order
+                    self.logger.info("reading metadata for version {}".format(self.output_path / dir_name))
+                    meta_file = self.output_path / dir_name / Constants.METADATA_XTAL_FILENAME
+                    futures.append(executor.submit(utils.read_config_file, str(meta_file)))
+                    self.previous_version_dirs.append(dir_name)
+                self.meta_history.extend(future.result() for future in futures)
 
         self.logger.info("setting version dir to {}".format(v_dir))
         self.version_dir = Path(v_dir)
@@ -522,13 +592,6 @@ class Collator:
 
         return v_dir
 
-    def read_metadata(self, version_dir):
-        self.logger.info("reading metadata for version {}".format(version_dir))
-        meta_file = version_dir / Constants.METADATA_XTAL_FILENAME
-
-        meta = utils.read_config_file(str(meta_file))
-        return meta
-
     def run(self, meta):
         self.logger.info("running collator...")
 
@@ -556,238 +619,35 @@ class Collator:
         num_event_maps = 0
 
         event_tables = self._find_event_tables()
-        forbidden_unattested_ligand_events = {}
-        for xtal_name, xtal in meta[Constants.META_XTALS].items():
-            dir = cryst_path / xtal_name
-
-            historical_xtal_data = self._collate_crystallographic_files_history(xtal_name)
-            curr_xtal_data = xtal[Constants.META_XTAL_FILES]
-            type = xtal[Constants.CONFIG_TYPE]
-            files_to_copy = {}
-
-            # handle the PDB file
-            pdb = curr_xtal_data.get(Constants.META_XTAL_PDB)
-            if pdb:
-                pdb_input = self.base_path / pdb[Constants.META_FILE]
-                if pdb_input.is_file():
-                    digest = utils.gen_sha256(pdb_input)
-                    old_digest = historical_xtal_data.get(Constants.META_XTAL_PDB, {}).get(Constants.META_SHA256)
-                    if digest != old_digest:
-                        # PDB is changed
-                        pdb_name = xtal_name + ".pdb"
-                        pdb_output = dir / pdb_name
-                        files_to_copy[Constants.META_XTAL_PDB] = (pdb_input, pdb_output, digest)
-
-                # handle the MTZ file
-                mtz = curr_xtal_data.get(Constants.META_XTAL_MTZ)
-                if mtz:
-                    mtz_file = mtz[Constants.META_FILE]
-                    mtz_input = self.base_path / mtz_file
-                    if mtz_input.is_file():
-                        digest = utils.gen_sha256(mtz_input)
-                        old_digest = historical_xtal_data.get(Constants.META_XTAL_MTZ, {}).get(Constants.META_SHA256)
-                        if digest != old_digest:
-                            mtz_name = xtal_name + ".mtz"
-                            mtz_output = dir / mtz_name
-                            files_to_copy[Constants.META_XTAL_MTZ] = (mtz_input, mtz_output, digest)
-                    elif type == Constants.CONFIG_TYPE_MODEL_BUILDING:
-                        self.logger.warn("mtz file {} not present".format(mtz_input))
-                else:
-                    self.logger.warn("MTZ entry missing for {}".format(xtal_name))
-
-                # handle the CIF file
-                cif = curr_xtal_data.get(Constants.META_XTAL_CIF)
-                if cif:
-                    cif_file = cif[Constants.META_FILE]
-                    cif_input = self.base_path / cif_file
-                    if cif_input.is_file():
-                        digest = utils.gen_sha256(cif_input)
-                        old_digest = historical_xtal_data.get(Constants.META_XTAL_CIF, {}).get(Constants.META_SHA256)
-                        if digest != old_digest:
-                            cif_name = xtal_name + ".cif"
-                            cif_output = dir / cif_name
-                            files_to_copy[Constants.META_XTAL_CIF] = (cif_input, cif_output, digest)
-                elif type == Constants.CONFIG_TYPE_MODEL_BUILDING:
-                    self.logger.warn("CIF entry missing for {}".format(xtal_name))
-
-                # Handle histroical ligand binding events (in particular pull up their event map SHA256s for comparing)
-                hist_event_maps = {}
-                for ligand_binding_data in historical_xtal_data.get(Constants.META_BINDING_EVENT, []):
-                    model = ligand_binding_data.get(Constants.META_PROT_MODEL)
-                    chain = ligand_binding_data.get(Constants.META_PROT_CHAIN)
-                    res = ligand_binding_data.get(Constants.META_PROT_RES)
-                    if model is not None and chain and res:
-                        hist_event_maps[(model, chain, res)] = ligand_binding_data
-
-                # Determine the ligands present and their coordinates
-                dataset_ligands = self.get_dataset_ligands(pdb_input)
-
-                # Match ligand to panddas event maps if possible and determine if those maps are new
-                best_event_map_paths = self.get_dataset_event_maps(xtal_name, dataset_ligands, event_tables)
-                identical_historical_event_maps = {}
-                unattested_ligand_events = {}
-                attested_ligand_events = {}
-                event_maps_to_copy = {}
-
-                for ligand_key in dataset_ligands:
-                    if ligand_key in best_event_map_paths:
-                        ligand_event_map_data = best_event_map_paths[ligand_key]
-                        path = ligand_event_map_data[0]
-                        if path:
-                            digest = utils.gen_sha256(path)
-                            ccp4_output = (
-                                cryst_path
-                                / xtal_name
-                                / "{}_{}_{}_{}.ccp4".format(xtal_name, ligand_key[0], ligand_key[1], ligand_key[2])
-                            )
-                            attested_ligand_events[ligand_key] = (
-                                path,
-                                ccp4_output,
-                                digest,
-                                ligand_key,
-                                ligand_event_map_data[1],
-                                ligand_event_map_data[2],
-                            )
-                            hist_data = hist_event_maps.get(ligand_key)
-                            # Track whether the event map actually is new by data
-                            if hist_data:
-                                if digest == hist_data.get(Constants.META_SHA256):
-                                    identical_historical_event_maps[ligand_key] = True
-                                else:
-                                    event_maps_to_copy[ligand_key] = True
-                            else:
-                                event_maps_to_copy[ligand_key] = True
-                    # Handle ligands that cannot be matched
-                    else:
-                        # Add those permitted ligands
-                        if xtal_name in self.panddas_missing_ok:
-                            self.logger.warn(
-                                "no PanDDA event map found for",
-                                xtal_name,
-                                "but this is OK as it's been added to the panddas_missing_ok",
-                                "list in the config file",
-                            )
-                            unattested_ligand_events[ligand_key] = True
-                        # Track forbidden ligands for informative error messages at the end of this function
-                        else:
-                            self.logger.error(
-                                "no PanDDA event map found. If you want to allow this then add",
-                                xtal_name,
-                                "to the panddas_missing_ok list in the config file",
-                            )
-                            forbidden_unattested_ligand_events[xtal_name] = ligand_key
-
-            else:
-                self.logger.error("PDB entry missing for {}".format(xtal_name))
-                return meta
-
-            # now copy the files
-            self.logger.info("{} has {} files to copy".format(xtal_name, len(files_to_copy)))
-            fdata = files_to_copy.get(Constants.META_XTAL_PDB)
-            data_to_add = {}
-            if fdata:
-                os.makedirs(self.output_path / dir)
-                f = shutil.copy2(fdata[0], self.output_path / fdata[1], follow_symlinks=True)
-                if not f:
-                    self.logger.error("Failed to copy PDB file {} to {}".format(fdata[0], self.output_path / fdata[1]))
-                else:
-                    data_to_add[Constants.META_XTAL_PDB] = {
-                        Constants.META_FILE: str(fdata[1]),
-                        Constants.META_SHA256: fdata[2],
-                    }
-                    # copy MTZ file
-                    fdata = files_to_copy.get(Constants.META_XTAL_MTZ)
-                    if fdata:
-                        f = shutil.copy2(fdata[0], self.output_path / fdata[1], follow_symlinks=True)
-                        if not f:
-                            self.logger.error(
-                                "Failed to copy MTZ file {} to {}".format(fdata[0], self.output_path / fdata[1])
-                            )
-                        else:
-                            data_to_add[Constants.META_XTAL_MTZ] = {
-                                Constants.META_FILE: str(fdata[1]),
-                                Constants.META_SHA256: fdata[2],
-                            }
-                    fdata = files_to_copy.get(Constants.META_XTAL_CIF)
-
-                    # copy CIF file
-                    if fdata:
-                        f = shutil.copy2(fdata[0], self.output_path / fdata[1], follow_symlinks=True)
-                        if not f:
-                            self.logger.error(
-                                "Failed to copy CIF file {} to {}".format(fdata[0], self.output_path / fdata[1])
-                            )
-                        else:
-                            data_to_add[Constants.META_XTAL_CIF] = {
-                                Constants.META_FILE: str(fdata[1]),
-                                Constants.META_SHA256: fdata[2],
-                            }
-                            try:
-                                mol = utils.gen_mol_from_cif(str(self.output_path / fdata[1]))
-                                smi = Chem.MolToSmiles(mol)
-                                data_to_add[Constants.META_XTAL_CIF][Constants.META_SMILES] = smi
-                            except:
-                                self.logger.warn('failed to generate SMILES for ligand {}'.format(xtal_name))
-
-                    # copy event maps that do not differ in SHA from previously known ones
-                    unsucessfully_copied_event_maps = {}
-                    if len(event_maps_to_copy) != 0:
-                        for ligand_key in event_maps_to_copy:
-                            source = attested_ligand_events[ligand_key][0]
-                            destination = attested_ligand_events[ligand_key][1]
-                            f = shutil.copy2(source, self.output_path / destination, follow_symlinks=True)
-                            if not f:
-                                self.logger.error(
-                                    "Failed to copy Panddas file {} to {}".format(
-                                        source, self.output_path / destination
-                                    )
-                                )
-                                # Mark that copying failed
-                                unsucessfully_copied_event_maps[ligand_key] = True
-
-                    # Create ligand binding events for the dataset
-                    ligand_binding_events = []
-                    for ligand_key in dataset_ligands:
-                        # Add binding events for ligands that can be matched to PanDDA event maps
-                        if ligand_key in attested_ligand_events:
-                            # Skip if failed to copy pandda event map
-                            if ligand_key in unsucessfully_copied_event_maps:
-                                continue
-                            attested_ligand_event_data = attested_ligand_events[ligand_key]
-                            data = {
-                                Constants.META_FILE: str(attested_ligand_event_data[1]),
-                                Constants.META_SHA256: attested_ligand_event_data[2],
-                                Constants.META_PROT_MODEL: ligand_key[0],
-                                Constants.META_PROT_CHAIN: ligand_key[1],
-                                Constants.META_PROT_RES: ligand_key[2],
-                                Constants.META_PROT_INDEX: attested_ligand_event_data[4],
-                                Constants.META_PROT_BDC: attested_ligand_event_data[5],
-                            }
-                        # Add binding events for permitted ligands without an event map
-                        elif ligand_key in unattested_ligand_events:
-                            data = {
-                                Constants.META_FILE: None,
-                                Constants.META_SHA256: None,
-                                Constants.META_PROT_MODEL: ligand_key[0],
-                                Constants.META_PROT_CHAIN: ligand_key[1],
-                                Constants.META_PROT_RES: ligand_key[2],
-                                Constants.META_PROT_INDEX: None,
-                                Constants.META_PROT_BDC: None,
-                            }
-                        # Skip if ligand key is not associated with a legal ligand
-                        else:
-                            continue
-                        ligand_binding_events.append(data)
-
-                    # Add data on the ligand binding events to the new dataset to add
-                    data_to_add[Constants.META_BINDING_EVENT] = ligand_binding_events
+        xtals = meta[Constants.META_XTALS]
+        # processing stops at the first crystal without a PDB file
+        to_copy = []
+        missing_pdb = None
+        for xtal_name, xtal in xtals.items():
+            if not xtal[Constants.META_XTAL_FILES].get(Constants.META_XTAL_PDB):
+                missing_pdb = xtal_name
+                break
+            to_copy.append((xtal_name, xtal))
 
-            new_xtal_data = {}
-            for k, v in historical_xtal_data.items():
-                new_xtal_data[k] = v
-            for k, v in data_to_add.items():
-                new_xtal_data[k] = v
-            xtal[Constants.META_XTAL_FILES] = new_xtal_data
+        # the crystals are independent and the work is mostly file I/O and hashing, which release the GIL
+        forbidden_unattested_ligand_events = {}
+        with ThreadPoolExecutor(max_workers=self.copy_workers) as executor:
+            futures = [
+                executor.submit(self._copy_xtal_files, xtal_name, xtal, cryst_path, event_tables)
+                for xtal_name, xtal in to_copy
+            ]
+            for (xtal_name, xtal), future in zip(to_copy, futures):
+                new_xtal_data, forbidden_ligand_key, messages = future.result()
+                for level, args in messages:
+                    self.logger.log(*args, level=level)
+                if forbidden_ligand_key is not None:
+                    forbidden_unattested_ligand_events[xtal_name] = forbidden_ligand_key
+                xtal[Constants.META_XTAL_FILES] = new_xtal_data
+        self.digest_cache.save()
+
+        if missing_pdb:
+            self.logger.error("PDB entry missing for {}".format(missing_pdb))
+            return meta
 
         # Handle the presence of ligand without event maps that have not been permitted
         if len(forbidden_unattested_ligand_events) != 0:
@@ -802,6 +662,252 @@ class Collator:
 
         return meta
 
+    def _copy_xtal_files(self, xtal_name, xtal, cryst_path, event_tables):
+        """
+        Copy the files for one crystal, if they have changed since the previous versions.
+        This runs in a worker thread so the messages are returned for the caller to log rather than being logged
+        directly, which keeps the messages for each crystal together and in order.
+
+        :param xtal_name: The crystal name
+        :param xtal: The crystal's metadata
+        :param cryst_path: The directory the crystal files are copied to, relative to the output dir
+        :param event_tables: The PanDDA event tables
+        :return: Tuple of the new crystal files metadata, the key of any ligand without an event map that is not
+            permitted (or None), and a list of (level, args) messages
+        """
+        messages = []
+
+        def log(level, *args):
+            messages.append((level, args))
+
+        forbidden_ligand_key = None
+        dir = cryst_path / xtal_name
+
+        historical_xtal_data = self._collate_crystallographic_files_history(xtal_name)
+        curr_xtal_data = xtal[Constants.META_XTAL_FILES]
+        type = xtal[Constants.CONFIG_TYPE]
+        files_to_copy = {}
+
+        # handle the PDB file
+        pdb = curr_xtal_data.get(Constants.META_XTAL_PDB)
+        pdb_input = self.base_path / pdb[Constants.META_FILE]
+        pdb_input_stat = utils.stat_or_none(pdb_input)
+        if pdb_input_stat and stat.S_ISREG(pdb_input_stat.st_mode):
+            digest = self.digest_cache.sha256(pdb_input, pdb_input_stat)
+            old_digest = historical_xtal_data.get(Constants.META_XTAL_PDB, {}).get(Constants.META_SHA256)
+            if digest != old_digest:
+                # PDB is changed
+                pdb_name = xtal_name + ".pdb"
+                pdb_output = dir / pdb_name
+                files_to_copy[Constants.META_XTAL_PDB] = (pdb_input, pdb_output, digest)
+
+        # handle the MTZ file
+        mtz = curr_xtal_data.get(Constants.META_XTAL_MTZ)
+        if mtz:
+            mtz_file = mtz[Constants.META_FILE]
+            mtz_input = self.base_path / mtz_file
+            mtz_input_stat = utils.stat_or_none(mtz_input)
+            if mtz_input_stat and stat.S_ISREG(mtz_input_stat.st_mode):
+                digest = self.digest_cache.sha256(mtz_input, mtz_input_stat)
+                old_digest = historical_xtal_data.get(Constants.META_XTAL_MTZ, {}).get(Constants.META_SHA256)
+                if digest != old_digest:
+                    mtz_name = xtal_name + ".mtz"
+                    mtz_output = dir / mtz_name
+                    files_to_copy[Constants.META_XTAL_MTZ] = (mtz_input, mtz_output, digest)
+            elif type == Constants.CONFIG_TYPE_MODEL_BUILDING:
+                log(1, "mtz file {} not present".format(mtz_input))
+        else:
+            log(1, "MTZ entry missing for {}".format(xtal_name))
+
+        # handle the CIF file
+        cif = curr_xtal_data.get(Constants.META_XTAL_CIF)
+        if cif:
+            cif_file = cif[Constants.META_FILE]
+            cif_input = self.base_path / cif_file
+            cif_input_stat = utils.stat_or_none(cif_input)
+            if cif_input_stat and stat.S_ISREG(cif_input_stat.st_mode):
+                digest = self.digest_cache.sha256(cif_input, cif_input_stat)
+                old_digest = historical_xtal_data.get(Constants.META_XTAL_CIF, {}).get(Constants.META_SHA256)
+                if digest != old_digest:
+                    cif_name = xtal_name + ".cif"
+                    cif_output = dir / cif_name
+                    files_to_copy[Constants.META_XTAL_CIF] = (cif_input, cif_output, digest)
+        elif type == Constants.CONFIG_TYPE_MODEL_BUILDING:
+            log(1, "CIF entry missing for {}".format(xtal_name))
+
+        # Handle histroical ligand binding events (in particular pull up their event map SHA256s for comparing)
+        hist_event_maps = {}
+        for ligand_binding_data in historical_xtal_data.get(Constants.META_BINDING_EVENT, []):
+            model = ligand_binding_data.get(Constants.META_PROT_MODEL)
+            chain = ligand_binding_data.get(Constants.META_PROT_CHAIN)
+            res = ligand_binding_data.get(Constants.META_PROT_RES)
+            if model is not None and chain and res:
+                hist_event_maps[(model, chain, res)] = ligand_binding_data
+
+        # Determine the ligands present and their coordinates
+        dataset_ligands = self.get_dataset_ligands(pdb_input)
+
+        # Match ligand to panddas event maps if possible and determine if those maps are new
+        best_event_map_paths = self.get_dataset_event_maps(xtal_name, dataset_ligands, event_tables)
+        identical_historical_event_maps = {}
+        unattested_ligand_events = {}
+        attested_ligand_events = {}
+        event_maps_to_copy = {}
+
+        for ligand_key in dataset_ligands:
+            if ligand_key in best_event_map_paths:
+                ligand_event_map_data = best_event_map_paths[ligand_key]
+                path = ligand_event_map_data[0]
+                if path:
+                    digest = self.digest_cache.sha256(path)
+                    ccp4_output = (
+                        cryst_path
+                        / xtal_name
+                        / "{}_{}_{}_{}.ccp4".format(xtal_name, ligand_key[0], ligand_key[1], ligand_key[2])
+                    )
+                    attested_ligand_events[ligand_key] = (
+                        path,
+                        ccp4_output,
+                        digest,
+                        ligand_key,
+                        ligand_event_map_data[1],
+                        ligand_event_map_data[2],
+                    )
+                    hist_data = hist_event_maps.get(ligand_key)
+                    # Track whether the event map actually is new by data
+                    if hist_data:
+                        if digest == hist_data.get(Constants.META_SHA256):
+                            identical_historical_event_maps[ligand_key] = True
+                        else:
+                            event_maps_to_copy[ligand_key] = True
+                    else:
+                        event_maps_to_copy[ligand_key] = True
+            # Handle ligands that cannot be matched
+            else:
+                # Add those permitted ligands
+                if xtal_name in self.panddas_missing_ok:
+                    log(
+                        1,
+                        "no PanDDA event map found for",
+                        xtal_name,
+                        "but this is OK as it's been added to the panddas_missing_ok",
+                        "list in the config file",
+                    )
+                    unattested_ligand_events[ligand_key] = True
+                # Track forbidden ligands for informative error messages at the end of this function
+                else:
+                    log(
+                        2,
+                        "no PanDDA event map found. If you want to allow this then add",
+                        xtal_name,
+                        "to the panddas_missing_ok list in the config file",
+                    )
+                    forbidden_ligand_key = ligand_key
+
+        # now copy the files
+        log(0, xtal_name, "has", len(files_to_copy), "files to copy")
+        fdata = files_to_copy.get(Constants.META_XTAL_PDB)
+        data_to_add = {}
+        if fdata:
+            os.makedirs(self.output_path / dir)
+            f = utils.fast_copy(fdata[0], self.output_path / fdata[1])
+            if not f:
+                log(2, "Failed to copy PDB file {} to {}".format(fdata[0], self.output_path / fdata[1]))
+            else:
+                data_to_add[Constants.META_XTAL_PDB] = {
+                    Constants.META_FILE: str(fdata[1]),
+                    Constants.META_SHA256: fdata[2],
+                }
+                # copy MTZ file
+                fdata = files_to_copy.get(Constants.META_XTAL_MTZ)
+                if fdata:
+                    f = utils.fast_copy(fdata[0], self.output_path / fdata[1])
+                    if not f:
+                        log(2, "Failed to copy MTZ file {} to {}".format(fdata[0], self.output_path / fdata[1]))
+                    else:
+                        data_to_add[Constants.META_XTAL_MTZ] = {
+                            Constants.META_FILE: str(fdata[1]),
+                            Constants.META_SHA256: fdata[2],
+                        }
+                fdata = files_to_copy.get(Constants.META_XTAL_CIF)
+
+                # copy CIF file
+                if fdata:
+                    f = utils.fast_copy(fdata[0], self.output_path / fdata[1])
+                    if not f:
+                        log(2, "Failed to copy CIF file {} to {}".format(fdata[0], self.output_path / fdata[1]))
+                    else:
+                        data_to_add[Constants.META_XTAL_CIF] = {
+                            Constants.META_FILE: str(fdata[1]),
+                            Constants.META_SHA256: fdata[2],
+                        }
+                        try:
+                            mol = utils.gen_mol_from_cif(str(self.output_path / fdata[1]))
+                            smi = Chem.MolToSmiles(mol)
+                            data_to_add[Constants.META_XTAL_CIF][Constants.META_SMILES] = smi
+                        except:
+                            log(1, 'failed to generate SMILES for ligand {}'.format(xtal_name))
+
+                # copy event maps that do not differ in SHA from previously known ones
+                unsucessfully_copied_event_maps = {}
+                if len(event_maps_to_copy) != 0:
+                    for ligand_key in event_maps_to_copy:
+                        source = attested_ligand_events[ligand_key][0]
+                        destination = attested_ligand_events[ligand_key][1]
+                        f = utils.fast_copy(source, self.output_path / destination)
+                        if not f:
+                            log(
+                                2,
+                                "Failed to copy Panddas file {} to {}".format(source, self.output_path / destination),
+                            )
+                            # Mark that copying failed
+                            unsucessfully_copied_event_maps[ligand_key] = True
+
+                # Create ligand binding events for the dataset
+                ligand_binding_events = []
+                for ligand_key in dataset_ligands:
+                    # Add binding events for ligands that can be matched to PanDDA event maps
+                    if ligand_key in attested_ligand_events:
+                        # Skip if failed to copy pandda event map
+                        if ligand_key in unsucessfully_copied_event_maps:
+                            continue
+                        attested_ligand_event_data = attested_ligand_events[ligand_key]
+                        data = {
+                            Constants.META_FILE: str(attested_ligand_event_data[1]),
+                            Constants.META_SHA256: attested_ligand_event_data[2],
+                            Constants.META_PROT_MODEL: ligand_key[0],
+                            Constants.META_PROT_CHAIN: ligand_key[1],
+                            Constants.META_PROT_RES: ligand_key[2],
+                            Constants.META_PROT_INDEX: attested_ligand_event_data[4],
+                            Constants.META_PROT_BDC: attested_ligand_event_data[5],
+                        }
+                    # Add binding events for permitted ligands without an event map
+                    elif ligand_key in unattested_ligand_events:
+                        data = {
+                            Constants.META_FILE: None,
+                            Constants.META_SHA256: None,
+                            Constants.META_PROT_MODEL: ligand_key[0],
+                            Constants.META_PROT_CHAIN: ligand_key[1],
+                            Constants.META_PROT_RES: ligand_key[2],
+                            Constants.META_PROT_INDEX: None,
+                            Constants.META_PROT_BDC: None,
+                        }
+                    # Skip if ligand key is not associated with a legal ligand
+                    else:
+                        continue
+                    ligand_binding_events.append(data)
+
+                # Add data on the ligand binding events to the new dataset to add
+                data_to_add[Constants.META_BINDING_EVENT] = ligand_binding_events
+
+        new_xtal_data = {}
+        for k, v in historical_xtal_data.items():
+            new_xtal_data[k] = v
+        for k, v in data_to_add.items():
+            new_xtal_data[k] = v
+
+        return new_xtal_data, forbidden_ligand_key, messages
+
     def _find_event_tables(self):
         event_tables = {}
         for input in self.inputs:
@@ -841,24 +947,20 @@ class Collator:
 
         # get any user defined overrides
         overrides = self.config.get("overrides", {})
+        xtal_overrides = overrides.get(Constants.META_XTALS, {})
 
         count = 0
         for metad in self.meta_history:
             count += 1
-            self.logger.info("munging metadata {}".format(count))
+            self.logger.info("munging metadata", count)
             xtals = metad[Constants.META_XTALS]
-            total = 0
-            for xtal_name, xtal_data in xtals.items():
-                total += 1
-                all_xtals[xtal_name] = xtal_data
-            self.logger.info("metadata {} has {} items".format(count, total))
+            all_xtals.update(xtals)
+            self.logger.info("metadata", count, "has", len(xtals), "items")
 
         count += 1
         self.logger.info("munging current metadata")
         xtals = meta["crystals"]
-        total = 0
         for xtal_name, xtal_data in xtals.items():
-            total += 1
             if xtal_name in all_xtals:
                 old_xtal_data = all_xtals[xtal_name]
                 status = self._get_xtal_status(xtal_name, old_xtal_data, xtal_data)
@@ -871,7 +973,7 @@ class Collator:
             all_xtals[xtal_name] = xtal_data
 
             # look for any user defined deprecations
-            xtal_override = overrides.get(Constants.META_XTALS, {}).get(xtal_name, {})
+            xtal_override = xtal_overrides.get(xtal_name) if xtal_overrides else None
             if xtal_override:
                 status_override = xtal_override.get(Constants.META_STATUS)
                 if status_override:
@@ -885,7 +987,7 @@ class Collator:
                     else:
                         self.logger.warn("status is overridden, but no reason was given")
 
-        self.logger.info("metadata {} has {} items".format(count, total))
+        self.logger.info("metadata {} has {} items".format(count, len(xtals)))
         self.logger.info(
             "munging resulted in {} total xtals, {} are new or updated".format(
                 len(all_xtals), len(new_or_updated_xtals)
@@ -923,14 +1025,14 @@ class Collator:
 
     def _write_metadata(self, meta, all_xtals, new_xtals):
         f = self.output_path / self.version_dir / Constants.METADATA_XTAL_FILENAME
-        with open(f, "w") as stream:
-            yaml.dump(meta, stream, sort_keys=False)
+        with open(f, "w", buffering=utils.WRITE_BUFFER_SIZE) as stream:
+            utils.dump_yaml_sections(meta, stream, stream_keys=(Constants.META_XTALS,))
         # f = self.output_path / self.version_dir / "all_xtals.yaml"
-        # with open(f, "w") as stream:
-        #     yaml.dump(all_xtals, stream, sort_keys=False)
-        #     f = self.output_path / self.version_dir / "new_xtals.yaml"
-        # with open(f, "w") as stream:
-        #     yaml.dump(new_xtals, stream, sort_keys=False)
+        # with open(f, "w", buffering=utils.WRITE_BUFFER_SIZE) as stream:
+        #     yaml.dump(all_xtals, stream, Dumper=utils.Dumper, sort_keys=False)
+        # f = self.output_path / self.version_dir / "new_xtals.yaml"
+        # with open(f, "w", buffering=utils.WRITE_BUFFER_SIZE) as stream:
+        #     yaml.dump(new_xtals, stream, Dumper=utils.Dumper, sort_keys=False)
 
     def _copy_config(self):
         f = shutil.copy2(self.config_file, self.output_path / self.version_dir / 'config.yaml')
@@ -972,10 +1074,14 @@ class Collator:
         for pandda_path, event_table in event_tables.items():
             # print('Processing', xtal_name, pandda_path)
             dataset_events = event_table[event_table[Constants.EVENT_TABLE_DTAG] == xtal_name]
-            for idx, row in dataset_events.iterrows():
-                event_idx = row[Constants.EVENT_TABLE_EVENT_IDX]
-                bdc = row[Constants.EVENT_TABLE_BDC]
-                x, y, z = row[Constants.EVENT_TABLE_X], row[Constants.EVENT_TABLE_Y], row[Constants.EVENT_TABLE_Z]
+            columns = [
+                Constants.EVENT_TABLE_EVENT_IDX,
+                Constants.EVENT_TABLE_BDC,
+                Constants.EVENT_TABLE_X,
+                Constants.EVENT_TABLE_Y,
+                Constants.EVENT_TABLE_Z,
+            ]
+            for event_idx, bdc, x, y, z in dataset_events[columns].itertuples(index=False, name=None):
                 distance = np.linalg.norm(np.array([x, y, z]).flatten() - ligand_coord.flatten())
                 # print('Distance:', distance)
                 for template in Constants.EVENT_MAP_TEMPLATES:
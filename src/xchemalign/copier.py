@@ -12,7 +12,6 @@
 
 import sys
 import argparse
-import shutil
 from pathlib import Path
 
 from paramiko import SSHClient
@@ -42,7 +41,7 @@ class FileCopier:
         self.logger = logger
 
     def do_copy(self, from_path, to_path):
-        return shutil.copy2(from_path, to_path, follow_symlinks=True)
+        return utils.fast_copy(from_path, to_path)
 
     def file_exists(self, path_to_check):
         return path_to_check.is_file()
@@ -165,6 +164,8 @@ class Copier:
         num_files = 0
         num_csv = 0
         datasets = {}
+        # the same for every crystal
+        expected_path = self.base_path / self.input_path / Constants.DEFAULT_MODEL_BUILDING_DIR
         for index, row in df.iterrows():
             count += 1
             xtal_name = row["CrystalName"]
@@ -175,7 +176,6 @@ class Copier:
 
             xtal_dir_path = collator.generate_xtal_dir(self.input_path, xtal_name)
             self.logger.info("processing {} {}".format(count, xtal_name))
-            expected_path = self.base_path / self.input_path / Constants.DEFAULT_MODEL_BUILDING_DIR
 
             file = row["RefinementPDB_latest"]
             if file:
@@ -11,7 +11,7 @@
 # limitations under the License.
 
 import argparse
-import json
+import functools
 import os
 from pathlib import Path
 
@@ -21,18 +21,30 @@ from rdkit import Geometry
 from xchemalign import utils
 
 
+@functools.lru_cache(maxsize=None)
+def _read_non_ligs():
+    # the same for every structure so only read it once, and as a set as it is checked for every HETATM line
+    return frozenset(utils.read_json(os.path.join(os.path.dirname(__file__), "non_ligs.json")))
+
+
+# record types left out of the apo file, with and without keeping the headers
+_APO_EXCLUDE_KEEP_HEADERS = ("CONECT", "SEQRES", "TITLE", "ANISOU")
+_APO_EXCLUDE = ("CONECT", "REMARK", "CRYST", "SEQRES", "HEADER", "TITLE", "ANISOU")
+
+
 class PDBXtal:
     def __init__(self, pdbfile, output_dir, biomol=None):
         self.pdbfile = pdbfile
         self.filebase = Path(pdbfile).stem
         self.output_dir = Path(output_dir)
         self.biomol = biomol
-        self.non_ligs = json.load(open(os.path.join(os.path.dirname(__file__), "non_ligs.json"), "r"))
+        self.non_ligs = _read_non_ligs()
         self.apo_file = None
         self.apo_solv_file = None
         self.apo_desolv_file = None
         self.ligand_base_file = None
         self.smiles = None
+        self._pdb_lines = None
 
     def validate(self):
         errors = 0
@@ -48,6 +60,16 @@ class PDBXtal:
 
         return errors
 
+    def _read_pdb_lines(self):
+        """
+        Read the lines of the PDB file, only touching the file the first time this is called.
+        The various extraction methods all make a pass over the same lines so they share this.
+        """
+        if self._pdb_lines is None:
+            with open(self.pdbfile, "r") as pdb:
+                self._pdb_lines = pdb.readlines()
+        return self._pdb_lines
+
     def add_biomol_remark(self):
         """
         Add contents of biomol/additional text file to the _apo.pdb file.
@@ -83,21 +105,13 @@ class PDBXtal:
         :returns: created XXX_apo.pdb file
         """
         lines = ""
-        if keep_headers:
-            include = ["CONECT", "SEQRES", "TITLE", "ANISOU"]
-        else:
-            include = ["CONECT", "REMARK", "CRYST", "SEQRES", "HEADER", "TITLE", "ANISOU"]
-
-        with open(self.pdbfile, "r") as pdb:
-            for line in pdb:
-                if (
-                    line.startswith("HETATM")
-                    and line.split()[3] not in self.non_ligs
-                    or any([line.startswith(x) for x in include])
-                ):
-                    continue
-                else:
-                    lines += line
+        include = _APO_EXCLUDE_KEEP_HEADERS if keep_headers else _APO_EXCLUDE
+
+        for line in self._read_pdb_lines():
+            if line.startswith("HETATM") and line.split()[3] not in self.non_ligs or line.startswith(include):
+                continue
+            else:
+                lines += line
 
         self.apo_file = self.output_dir / (self.filebase + "_apo.pdb")
         f = open(self.apo_file, "w")
@@ -159,11 +173,10 @@ class PDBXtal:
             raise ValueError('Unexpected residue ID: ' + res_id)
 
         ligand_lines = []
-        with open(self.pdbfile, "r") as pdb:
-            for line in pdb:
-                if line.startswith("HETATM") or line.startswith("ATOM"):
-                    if line[21] == chain and line[22:26] == id:
-                        ligand_lines.append(line)
+        for line in self._read_pdb_lines():
+            if line.startswith("HETATM") or line.startswith("ATOM"):
+                if line[21] == chain and line[22:26] == id:
+                    ligand_lines.append(line)
         return ligand_lines
 
     def extract_residue(self, chain, res_id):
@@ -12,18 +12,51 @@
 
 import atexit
 import datetime
+import errno
 import hashlib
+import mmap
 import os
 from pathlib import Path
+import shutil
+import sqlite3
 import sys
 import json
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    from yaml import CDumper as Dumper
+except ImportError:
+    from yaml import Dumper
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 from rdkit import Chem, Geometry
 from gemmi import cif
 
 _DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+WRITE_BUFFER_SIZE = 1 << 20
+# large reads and writes suit the parallel filesystems (GPFS, Lustre) that the data is usually on
+_COPY_BUFFER_SIZE = 4 << 20
+_HASH_SINGLE_UPDATE_SIZE = 1 << 30
+_HASH_CHUNK_SIZE = 64 << 20
+# the ioctl for a reflink copy, from linux/fs.h as the fcntl module only has it from Python 3.12
+_FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
 
 
 class Constants:
@@ -56,6 +89,7 @@ class Constants:
     CONFIG_TARGET_NAME = "target_name"
     CONFIG_REF_DATASETS = "ref_datasets"
     CONFIG_EXCLUDE = 'exclude'
+    CONFIG_COPY_WORKERS = "copy_workers"
     META_RUN_ON = "run_on"
     META_INPUT_DIRS = "input_dirs"
     META_VERSION_NUM = "version_number"
@@ -137,6 +171,8 @@ class Constants:
     SOAKDB_COL_REFINEMENT_OUTCOME = "RefinementOutcome"
     CRYSTAL_NEW = "crystal_new"
     ASSEMBLIES_FILENAME = "assemblies.yaml"
+    EXTRACT_DIGESTS_FILENAME = ".extract_digests.json"
+    DIGEST_CACHE_FILENAME = ".digest_cache.sqlite"
     PREVIOUS_OUTPUT_DIR = ""
 
 
@@ -167,6 +203,7 @@ class Logger:
         """
         self.console = console
         self.level = 0
+        self.num_infos = 0
         self.infos = []
         self.warnings = []
         self.errors = []
@@ -204,6 +241,12 @@ class Logger:
         :return:
         """
 
+        if level == 0:
+            self.num_infos += 1
+            # info messages are not in the report so if they are not being output there is nothing more to do
+            if level < self.level:
+                return
+
         msg = " ".join([str(s) for s in args])
 
         if level == 0:
@@ -228,7 +271,7 @@ class Logger:
                 print(key, *args, file=self.logfile, **kwargs)
 
     def get_num_messages(self):
-        return len(self.infos), len(self.warnings), len(self.errors)
+        return self.num_infos, len(self.warnings), len(self.errors)
 
     def report(self):
         """
@@ -251,13 +294,271 @@ class Logger:
 
 
 def gen_sha256(file):
+    """
+    Generate the SHA256 digest of a file.
+    The file is memory mapped and, unless it is very large, hashed with a single update() call. OpenSSL's accelerated
+    implementation then runs over the whole file with the GIL released, so files hashed from several threads (see
+    gen_sha256_many()) are hashed in parallel, and nothing is copied into Python bytes objects.
+    """
     sha256_hash = hashlib.sha256()
     with open(file, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
+        size = os.fstat(f.fileno()).st_size
+        # an empty file cannot be mapped, but its digest is that of no data
+        if size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                if size <= _HASH_SINGLE_UPDATE_SIZE:
+                    sha256_hash.update(view)
+                else:
+                    # hash very large files in slices so that their pages can be dropped as the hashing goes
+                    for offset in range(0, size, _HASH_CHUNK_SIZE):
+                        sha256_hash.update(view[offset : offset + _HASH_CHUNK_SIZE])
     return sha256_hash.hexdigest()
 
 
+def available_cpu_count():
+    """
+    The number of CPUs this process can run on.
+    Unlike os.cpu_count() this respects the CPU affinity, e.g. the CPUs that a SLURM job has been allocated.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def gen_sha256_many(files):
+    """
+    Generate the SHA256 digests of several files.
+    SHA256 is serial within a file, but hashlib releases the GIL while hashing so separate files are hashed in
+    parallel threads.
+
+    :param files: The files to hash
+    :return: List of the hex digests, in the same order as the files
+    """
+    if len(files) < 2:
+        return [gen_sha256(f) for f in files]
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count() or 4)) as executor:
+        return list(executor.map(gen_sha256, files))
+
+
+class DigestCache:
+    """
+    Cache of the SHA256 digests of files so that files that have not changed since an earlier run are not hashed
+    again. Entries are keyed by the real path of the file and are only used if its size and modification time are
+    unchanged. The cache is held in memory and saved to an SQLite database.
+    The cache is only an optimisation, so if the database cannot be read or written (e.g. SQLite's locking fails on
+    a network filesystem) a warning is logged and everything is hashed as if there was no cache.
+    """
+
+    def __init__(self, db_file, logger=None):
+        self.db_file = str(db_file)
+        self.logger = logger
+        self.digests = {}
+        self.updated = {}
+        if os.path.isfile(self.db_file):
+            try:
+                with closing(sqlite3.connect(self.db_file)) as conn:
+                    for path, size, mtime_ns, sha256 in conn.execute(
+                        "SELECT path, size, mtime_ns, sha256 FROM digests"
+                    ):
+                        self.digests[path] = (size, mtime_ns, sha256)
+            except (sqlite3.DatabaseError, OSError) as e:
+                self._warn("failed to read digest cache {}, continuing without it: {}".format(self.db_file, e))
+                self.digests.clear()
+                # don't try to write to it either, it can be deleted to start a new cache
+                self.db_file = None
+
+    def _warn(self, msg):
+        if self.logger:
+            self.logger.warn(msg)
+
+    def _lookup(self, file, st=None):
+        path = os.path.realpath(file)
+        if st is None:
+            st = os.stat(path)
+        entry = (st.st_size, st.st_mtime_ns)
+        cached = self.digests.get(path)
+        if cached and cached[:2] == entry:
+            return path, entry, cached[2]
+        return path, entry, None
+
+    def sha256(self, file, st=None):
+        """
+        Get the SHA256 digest of a file, only hashing it if it is not in the cache or has changed.
+
+        :param file: The file to hash
+        :param st: The os.stat_result of the file if the caller already has it, to save stat'ing it again
+        :return: The SHA256 hex digest
+        """
+        path, entry, digest = self._lookup(file, st)
+        if digest is None:
+            digest = gen_sha256(path)
+            self.digests[path] = self.updated[path] = entry + (digest,)
+        return digest
+
+    def sha256_many(self, files, stats=None):
+        """
+        Get the SHA256 digests of several files, hashing those not in the cache in parallel like gen_sha256_many().
+
+        :param files: The files to hash
+        :param stats: The os.stat_result of each of the files if the caller already has them
+        :return: List of the hex digests, in the same order as the files
+        """
+        lookups = [self._lookup(f, st) for f, st in zip(files, stats or [None] * len(files))]
+        misses = [lookup for lookup in lookups if lookup[2] is None]
+        for (path, entry, _), digest in zip(misses, gen_sha256_many([lookup[0] for lookup in misses])):
+            self.digests[path] = self.updated[path] = entry + (digest,)
+        return [self.digests[path][2] for path, _, _ in lookups]
+
+    def save(self):
+        """
+        Write the entries added since the cache was read or last saved to the database.
+        """
+        if not self.updated or not self.db_file:
+            return
+        try:
+            with closing(sqlite3.connect(self.db_file)) as conn, conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS digests "
+                    "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+                )
+                conn.executemany(
+                    "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)",
+                    [(path,) + entry for path, entry in self.updated.items()],
+                )
+        except (sqlite3.DatabaseError, OSError) as e:
+            self._warn("failed to save digest cache {}: {}".format(self.db_file, e))
+            return
+        self.updated = {}
+
+
+def _copy_readinto(fsrc, fdst):
+    # copy through a single reused buffer
+    buf = bytearray(_COPY_BUFFER_SIZE)
+    view = memoryview(buf)
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fsrc.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    while n := fsrc.readinto(buf):
+        fdst.write(view[:n])
+
+
+def _clone(fsrc, fdst):
+    # reflink the data, which only works within the one filesystem and only on some (e.g. btrfs, xfs)
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _copy_file_range(fsrc, fdst):
+    # copy the data within the kernel, which older kernels only support within the one filesystem
+    # returns the number of bytes copied, leaving both file positions after them
+    if not hasattr(os, "copy_file_range"):
+        return 0
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    copied = 0
+    try:
+        while n := os.copy_file_range(infd, outfd, 1 << 30):
+            copied += n
+    except OSError as e:
+        if copied == 0 and e.errno in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+            return 0
+        raise
+    return copied
+
+
+def _sendfile(fsrc, fdst):
+    # copy page to page within the kernel, which unlike copy_file_range works across filesystems on any kernel
+    # returns the number of bytes copied, leaving both file positions after them
+    if not hasattr(os, "sendfile"):
+        return 0
+    infd, outfd = fsrc.fileno(), fdst.fileno()
+    offset = 0
+    remaining = os.fstat(infd).st_size
+    try:
+        while remaining > 0:
+            n = os.sendfile(outfd, infd, offset, min(remaining, 1 << 30))
+            if n == 0:
+                break
+            offset += n
+            remaining -= n
+    except OSError as e:
+        if offset == 0 and e.errno in (errno.ENOSYS, errno.EINVAL, errno.ENOTSOCK, errno.EOPNOTSUPP):
+            return 0
+        raise
+    if offset:
+        # the explicit offsets leave the source position alone, so move it past what was copied
+        os.lseek(infd, offset, os.SEEK_SET)
+    return offset
+
+
+def fast_copy(src, dst):
+    """
+    Copy a file and its stat like shutil.copy2(), letting the kernel do the copy where it can.
+    The file is reflinked on filesystems that support it, otherwise copied with copy_file_range or sendfile. Whatever
+    the kernel does not copy is copied through a buffer, so the copy is always identical to the source and the digest
+    of the source applies to it.
+
+    :param src: The file to copy
+    :param dst: The file to copy to
+    :return: dst
+    :raises shutil.SameFileError: if src and dst are the same file, which opening dst would truncate
+    """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        raise shutil.SameFileError("{!r} and {!r} are the same file".format(src, dst))
+    with open(src, "rb", buffering=0) as fsrc, open(dst, "wb") as fdst:
+        if not _clone(fsrc, fdst):
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = _copy_file_range(fsrc, fdst) or _sendfile(fsrc, fdst)
+            # the kernel copies can stop short, and copy nothing at all on some filesystems (e.g. FUSE, network and
+            # /proc, whose files also report no size), so carry on from where they stopped
+            if not copied or copied < size:
+                _copy_readinto(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+class _SectionDumper(Dumper):
+    # every section is a separate document whose anchors are numbered from id001 again, so repeated anchors in the
+    # combined file would be rejected when it is read - write shared objects out in full instead
+    def ignore_aliases(self, data):
+        return True
+
+
+def dump_yaml_sections(data, stream, stream_keys=()):
+    """
+    Write a dict as YAML one top level key at a time, flushing after each.
+    PyYAML builds the node tree for everything passed to a single dump() so this keeps only one section in memory.
+    The values of the keys in stream_keys are mappings that are written one entry at a time.
+
+    :param data: The dict to write
+    :param stream: The open file to write to
+    :param stream_keys: Top level keys whose entries should be written individually
+    """
+    for key, value in data.items():
+        if key in stream_keys and value:
+            stream.write("{}:\n".format(key))
+            for k, v in value.items():
+                text = yaml.dump({k: v}, Dumper=_SectionDumper, sort_keys=False, default_flow_style=False)
+                stream.write("".join("  " + line for line in text.splitlines(keepends=True)))
+        else:
+            yaml.dump({key: value}, stream, Dumper=_SectionDumper, sort_keys=False, default_flow_style=False)
+        stream.flush()
+
+
+def stat_or_none(path):
+    """
+    Stat a path, returning None if it does not exist.
+    A single os.stat() answers both the exists and the file/directory type questions.
+    """
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+
 def to_datetime(datetime_str):
     datetime_object = datetime.datetime.strptime(datetime_str, _DATETIME_FORMAT)
     return datetime_object
@@ -267,12 +568,10 @@ def read_config_file(filename):
     if os.path.isfile(filename):
         if filename.endswith(".yaml"):
             with open(filename, "r") as stream:
-                config = yaml.safe_load(stream)
+                config = yaml.load(stream, Loader=SafeLoader)
                 return config
         elif filename.endswith(".json"):
-            with open(filename, "r") as stream:
-                config = json.load(stream)
-                return config
+            return read_json(filename)
         else:
             raise ValueError("Only .json or .yaml files are supported. {} was specified".format(filename))
     else:
@@ -280,6 +579,18 @@ def read_config_file(filename):
         raise ValueError(msg)
 
 
+def read_json(filename):
+    """
+    Read a JSON file, using orjson if it is installed as it is much faster than the json module.
+    """
+    with open(filename, "rb") as stream:
+        data = stream.read()
+    if orjson:
+        return orjson.loads(data)
+    else:
+        return json.loads(data)
+
+
 def find_property(my_dict, key, default=None):
     if key in my_dict:
         return my_dict[key]
@@ -287,6 +598,24 @@ def find_property(my_dict, key, default=None):
         return default
 
 
+# marks a missing key in find_nested(), as None can be a value
+_MISSING = object()
+
+
+def find_nested(my_dict, *keys):
+    """
+    Look up a value in nested dicts, e.g. find_nested(d, 'a', 'b') is d['a']['b'].
+    Unlike chaining .get(key, {}) calls this does not create an empty dict for each missing level.
+
+    :return: The value, or None if any of the keys is missing
+    """
+    for key in keys:
+        my_dict = my_dict.get(key, _MISSING)
+        if my_dict is _MISSING:
+            return None
+    return my_dict
+
+
 def find_path(my_dict, key, default=None):
     value = find_property(my_dict, key, default=default)
     if value:
@@ -0,0 +1,108 @@
+import os
+import shutil
+from pathlib import Path
+
+import gemmi
+import pytest
+
+pytest.importorskip("ligand_neighbourhood_alignment")
+
+from xchemalign import aligner, utils
+from xchemalign.aligner import Aligner, _read_cell_sg
+from xchemalign.utils import Constants
+
+MODEL_BUILDING_DIR = Path(
+    "test-data/inputs_1/dls/labxchem/data/2020/lb27995-1/processing/analysis/model_building/Mpro-IBM0045"
+)
+
+
+@pytest.mark.parametrize("pdb", sorted(Path("test-data").rglob("*.pdb")), ids=str)
+def test_read_cell_sg(pdb):
+    structure = gemmi.read_structure(str(pdb))
+    spacegroup, cell = _read_cell_sg(pdb)
+    assert spacegroup == structure.spacegroup_hm
+    expected = structure.cell
+    assert cell == pytest.approx((expected.a, expected.b, expected.c, expected.alpha, expected.beta, expected.gamma))
+
+
+def test_read_cell_sg_without_cryst1(tmp_path):
+    # falls back to reading the whole structure, which gives the default cell
+    pdb = tmp_path / "no_cryst1.pdb"
+    with open(MODEL_BUILDING_DIR / "Refine_0017" / "refine_16.pdb") as f:
+        pdb.write_text("".join(line for line in f if not line.startswith("CRYST1")))
+    structure = gemmi.read_structure(str(pdb))
+    spacegroup, cell = _read_cell_sg(pdb)
+    assert spacegroup == structure.spacegroup_hm
+    assert cell == (1.0, 1.0, 1.0, 90.0, 90.0, 90.0)
+
+
+def test_read_cell_sg_non_utf8_header(tmp_path):
+    pdb = tmp_path / "latin1.pdb"
+    with open(MODEL_BUILDING_DIR / "Refine_0017" / "refine_16.pdb", "rb") as f:
+        pdb.write_bytes(b"REMARK   1 caf\xe9\n" + f.read())
+    structure = gemmi.read_structure(str(pdb))
+    spacegroup, cell = _read_cell_sg(pdb)
+    assert spacegroup == structure.spacegroup_hm
+    expected = structure.cell
+    assert cell == pytest.approx((expected.a, expected.b, expected.c, expected.alpha, expected.beta, expected.gamma))
+
+
+def _extract(version_dir, cif_digest):
+    a = Aligner(version_dir, Constants.METADATA_XTAL_FILENAME, None, logger=utils.Logger(console=None))
+    crystals = {
+        "Mpro-IBM0045": {
+            Constants.META_XTAL_FILES: {
+                Constants.META_XTAL_CIF: {
+                    Constants.META_FILE: "upload_1/crystallographic_files/Mpro-IBM0045/Mpro-IBM0045.cif",
+                    Constants.META_SHA256: cif_digest,
+                }
+            }
+        }
+    }
+    structure = {Constants.META_AIGNED_STRUCTURE: a.aligned_dir / "Mpro-IBM0045" / "Mpro-IBM0045_s1.pdb"}
+    aligner_meta = {
+        Constants.META_XTALS: {"Mpro-IBM0045": {Constants.META_ALIGNED_FILES: {"A": {"1101": {"s1": structure}}}}}
+    }
+    num_errors = a._extract_components(crystals, aligner_meta)
+    assert num_errors == 0
+    assert structure[Constants.META_PDB_APO] == "upload_1/aligned_files/Mpro-IBM0045/Mpro-IBM0045_s1_apo.pdb"
+
+
+def test_extract_components_reuse(tmp_path, monkeypatch):
+    version_dir = tmp_path / "upload_1"
+    aligned_dir = version_dir / Constants.META_ALIGNED_FILES / "Mpro-IBM0045"
+    xtal_dir = version_dir / Constants.META_XTAL_FILES / "Mpro-IBM0045"
+    aligned_dir.mkdir(parents=True)
+    xtal_dir.mkdir(parents=True)
+    pdb = aligned_dir / "Mpro-IBM0045_s1.pdb"
+    shutil.copy(MODEL_BUILDING_DIR / "Refine_0017" / "refine_16.pdb", pdb)
+    shutil.copy(MODEL_BUILDING_DIR / "compound" / "Z68337194.cif", xtal_dir / "Mpro-IBM0045.cif")
+    apo = aligned_dir / "Mpro-IBM0045_s1_apo.pdb"
+
+    _extract(version_dir, "cif1")
+    assert apo.is_file()
+
+    # an unchanged structure is not extracted again, even when run from another directory
+    os.utime(apo, ns=(0, 0))
+    monkeypatch.chdir(tmp_path)
+    _extract(Path("upload_1"), "cif1")
+    assert apo.stat().st_mtime_ns == 0
+
+    # a changed CIF means extracting again
+    _extract(Path("upload_1"), "cif2")
+    assert apo.stat().st_mtime_ns != 0
+
+    # as does a changed structure
+    os.utime(apo, ns=(0, 0))
+    with open(pdb, "a") as f:
+        f.write("REMARK changed\n")
+    _extract(Path("upload_1"), "cif2")
+    assert apo.stat().st_mtime_ns != 0
+
+    # as does a new version of the extraction
+    os.utime(apo, ns=(0, 0))
+    monkeypatch.setattr(aligner, "_EXTRACT_VERSION", aligner._EXTRACT_VERSION + 1)
+    aligner._get_extract_salt.cache_clear()
+    _extract(Path("upload_1"), "cif2")
+    aligner._get_extract_salt.cache_clear()
+    assert apo.stat().st_mtime_ns != 0
@@ -0,0 +1,19 @@
+import shutil
+
+import pytest
+
+pytest.importorskip("paramiko")
+pytest.importorskip("scp")
+
+from xchemalign.copier import FileCopier
+
+
+def test_file_copier_same_file(tmp_path):
+    # a base path that overlaps the output path must fail rather than truncate the input
+    src = tmp_path / "input.pdb"
+    src.write_text("CRYST1\n")
+    link = tmp_path / "output.pdb"
+    link.symlink_to(src)
+    with pytest.raises(shutil.SameFileError):
+        FileCopier(None).do_copy(src, link)
+    assert src.read_text() == "CRYST1\n"
@@ -0,0 +1,189 @@
+import io
+import os
+import shutil
+
+import pytest
+import yaml
+
+from xchemalign import utils
+
+
+def test_dump_yaml_sections_round_trip():
+    shared_1 = [1, 2]
+    shared_2 = {'a': 'b'}
+    data = {
+        'run_on': '2023-01-01',
+        'other': {'x': shared_1, 'y': shared_1},
+        'crystals': {'A': {'x': shared_1, 'y': shared_1}, 'B': {'x': shared_2, 'y': shared_2}},
+    }
+
+    stream = io.StringIO()
+    utils.dump_yaml_sections(data, stream, stream_keys=('crystals',))
+
+    assert yaml.safe_load(stream.getvalue()) == data
+
+
+def test_find_nested():
+    data = {'a': {'b': {'c': 1}, 'n': None}}
+    assert utils.find_nested(data, 'a', 'b', 'c') == 1
+    assert utils.find_nested(data, 'a', 'b') == {'c': 1}
+    assert utils.find_nested(data, 'a', 'n') is None
+    assert utils.find_nested(data, 'a', 'x', 'c') is None
+    assert utils.find_nested(data, 'x') is None
+
+
+@pytest.fixture
+def src_file(tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(os.urandom(3_000_001))
+    return src
+
+
+def test_fast_copy(src_file, tmp_path):
+    dst = tmp_path / 'dst.bin'
+    assert utils.fast_copy(src_file, dst) == dst
+    assert dst.read_bytes() == src_file.read_bytes()
+    assert dst.stat().st_mtime_ns == src_file.stat().st_mtime_ns
+
+
+def test_fast_copy_same_file(src_file, tmp_path):
+    # copying a file onto itself, directly or through a symlink, must not truncate it
+    data = src_file.read_bytes()
+    link = tmp_path / 'link.bin'
+    link.symlink_to(src_file)
+    for dst in (src_file, link):
+        with pytest.raises(shutil.SameFileError):
+            utils.fast_copy(src_file, dst)
+    assert src_file.read_bytes() == data
+
+
+def test_fast_copy_fallback_order(src_file, tmp_path, monkeypatch):
+    # kernel copies that copy nothing from a non-empty file fall through to the next method
+    calls = []
+
+    def copy_file_range(*args):
+        calls.append('copy_file_range')
+        return 0
+
+    def sendfile(*args):
+        calls.append('sendfile')
+        return 0
+
+    monkeypatch.setattr(utils, '_clone', lambda fsrc, fdst: False)
+    monkeypatch.setattr(os, 'copy_file_range', copy_file_range, raising=False)
+    monkeypatch.setattr(os, 'sendfile', sendfile, raising=False)
+    dst = tmp_path / 'dst.bin'
+    utils.fast_copy(src_file, dst)
+    assert calls == ['copy_file_range', 'sendfile']
+    assert dst.read_bytes() == src_file.read_bytes()
+
+
+@pytest.mark.skipif(not hasattr(os, 'copy_file_range'), reason='needs copy_file_range')
+def test_fast_copy_short_kernel_copy(src_file, tmp_path, monkeypatch):
+    # a kernel copy that stops part way is finished off through a buffer
+    real_copy_file_range = os.copy_file_range
+    copied = []
+
+    def copy_file_range(infd, outfd, count):
+        if copied:
+            return 0
+        copied.append(real_copy_file_range(infd, outfd, 1000))
+        return copied[0]
+
+    monkeypatch.setattr(utils, '_clone', lambda fsrc, fdst: False)
+    monkeypatch.setattr(os, 'copy_file_range', copy_file_range)
+    dst = tmp_path / 'dst.bin'
+    utils.fast_copy(src_file, dst)
+    assert copied == [1000]
+    assert dst.read_bytes() == src_file.read_bytes()
+
+
+@pytest.mark.skipif(not os.path.isfile('/proc/cpuinfo'), reason='needs /proc')
+def test_fast_copy_unsized_file(tmp_path):
+    # files in /proc report no size and the kernel copies give nothing for them
+    dst = tmp_path / 'cpuinfo'
+    utils.fast_copy('/proc/cpuinfo', dst)
+    with open('/proc/cpuinfo', 'rb') as f:
+        assert dst.read_bytes() == f.read()
+
+
+@pytest.mark.skipif(not hasattr(os, 'sendfile'), reason='needs sendfile')
+def test_fast_copy_short_sendfile(src_file, tmp_path, monkeypatch):
+    # sendfile is used when copy_file_range copies nothing, and if it stops part way the rest is copied from there
+    real_sendfile = os.sendfile
+    copied = []
+
+    def sendfile(outfd, infd, offset, count):
+        if copied:
+            return 0
+        copied.append(real_sendfile(outfd, infd, offset, 1000))
+        return copied[0]
+
+    monkeypatch.setattr(utils, '_clone', lambda fsrc, fdst: False)
+    monkeypatch.setattr(os, 'copy_file_range', lambda *args: 0, raising=False)
+    monkeypatch.setattr(os, 'sendfile', sendfile)
+    dst = tmp_path / 'dst.bin'
+    utils.fast_copy(src_file, dst)
+    assert copied == [1000]
+    assert dst.read_bytes() == src_file.read_bytes()
+
+
+def test_digest_cache(tmp_path, monkeypatch):
+    hashed = []
+    gen_sha256 = utils.gen_sha256
+
+    def counting_gen_sha256(file):
+        hashed.append(os.path.basename(file))
+        return gen_sha256(file)
+
+    monkeypatch.setattr(utils, 'gen_sha256', counting_gen_sha256)
+    db_file = tmp_path / 'digests.sqlite'
+    a = tmp_path / 'a.txt'
+    b = tmp_path / 'b.txt'
+    a.write_text('aaa')
+    b.write_text('bbb')
+    os.utime(b, ns=(1_000_000_000, 1_000_000_000))
+
+    cache = utils.DigestCache(db_file)
+    assert cache.sha256_many([a, b]) == [gen_sha256(a), gen_sha256(b)]
+    assert sorted(hashed) == ['a.txt', 'b.txt']
+
+    # hits
+    hashed.clear()
+    assert cache.sha256(a) == gen_sha256(a)
+    assert cache.sha256_many([a, b]) == [gen_sha256(a), gen_sha256(b)]
+    assert hashed == []
+
+    # saved and read back
+    cache.save()
+    cache = utils.DigestCache(db_file)
+    assert cache.sha256_many([a, b]) == [gen_sha256(a), gen_sha256(b)]
+    assert hashed == []
+
+    # a change of size or of modification time means hashing again
+    a.write_text('aaaa')
+    b_mtime_ns = b.stat().st_mtime_ns
+    b.write_text('BBB')
+    os.utime(b, ns=(b_mtime_ns + 1, b_mtime_ns + 1))
+    assert cache.sha256(a) == gen_sha256(a)
+    assert cache.sha256(b) == gen_sha256(b)
+    assert hashed == ['a.txt', 'b.txt']
+
+
+def test_digest_cache_unusable_database(tmp_path):
+    # a corrupt or unwritable database means carrying on without the cache
+    logger = utils.Logger(console=None)
+    a = tmp_path / 'a.txt'
+    a.write_text('aaa')
+
+    db_file = tmp_path / 'digests.sqlite'
+    db_file.write_bytes(b'not a database' * 100)
+    cache = utils.DigestCache(db_file, logger=logger)
+    assert cache.sha256(a) == utils.gen_sha256(a)
+    cache.save()
+    assert len(logger.warnings) == 1
+
+    cache = utils.DigestCache(tmp_path / 'missing' / 'digests.sqlite', logger=logger)
+    assert cache.sha256(a) == utils.gen_sha256(a)
+    cache.save()
+    assert len(logger.warnings) == 2